@@ -2,14 +2,43 @@
 # -*- coding: utf-8 -*-
 from __future__ import annotations
 
-from typing import TYPE_CHECKING, Dict, Optional, Tuple
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
 import asyncio
+import atexit
+import concurrent.futures
+import csv
+import heapq
+import html
 import importlib.util
+import io
 import json
 import logging
+import logging.handlers
 import os
+import queue
 import random
+import re
+import signal
+import sqlite3
+import threading
+import time
 
 from FunPayAPI.updater.events import NewOrderEvent, NewMessageEvent
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
@@ -30,6 +59,8 @@ UUID = "298845c5-9c90-4912-b599-7ca26f94a7b1"
 SETTINGS_PAGE = False
 
 CONFIG_FILE = "plugins/starsgifter_config.json"
+STATE_DB_FILE = "plugins/starsgifter_state.db"
+GIFTS_CACHE_FILE = "plugins/starsgifter_gifts.json"
 DEFAULT_CONFIG = {
     "lot_stars_mapping": {},
     "random_gifts": {
@@ -45,8 +76,146 @@ DEFAULT_CONFIG = {
         "phone_number": "",
         "session_name": "starsgifter_session",
     },
+    "pyrogram_accounts": [],
+    "senders": {
+        "error_threshold": 3,
+        "error_cooldown": 60,
+    },
+    "delivery": {
+        "workers": 3,
+        "gift_retries": 2,
+        "retry_backoff": 2.0,
+        "max_lots": 100,
+        "progress_every": 10,
+    },
+    "storage": {
+        "batch_size": 50,
+        "flush_interval": 1.0,
+    },
+    "outbound": {
+        "coalesce_window": 0.5,
+        "max_length": 2000,
+        "retries": 3,
+        "retry_backoff": 1.0,
+    },
+    "balance": {
+        "enabled": True,
+        "refresh_interval": 300,
+    },
+    "metrics": {
+        "http_host": "127.0.0.1",
+        "http_port": 0,
+        "file": "",
+        "file_interval": 30,
+    },
+    "recipient_cache": {
+        "max_size": 1000,
+        "ttl": 3600,
+        "prefetch": True,
+        "verify": True,
+    },
+    "planner": {
+        "max_amount": 10000,
+    },
+    "rate_limit": {
+        "rate": 0.5,
+        "burst": 2,
+        "min_rate": 0.1,
+        "max_rate": 3.0,
+        "max_flood_retries": 5,
+        "max_flood_wait": 900,
+    },
+    "config": {
+        "save_delay": 1.0,
+        "reload_interval": 5,
+    },
+    "catalog": {
+        "enabled": True,
+        "ttl": 3600,
+        "include_limited": False,
+    },
+    "startup": {
+        "connect_retries": 5,
+        "connect_backoff": 10,
+        "ready_timeout": 300,
+    },
+    "states": {
+        "ttl": 86400,
+        "remind_before": 3600,
+        "sweep_interval": 60,
+    },
+    "logging": {
+        "async": True,
+        "repeat_interval": 60,
+        "repeat_burst": 3,
+    },
+    "shutdown": {
+        "drain_timeout": 30,
+        "checkpoint_timeout": 15,
+    },
 }
 
+ORDER_WAITING = "waiting"
+ORDER_QUEUED = "queued"
+ORDER_DELIVERING = "delivering"
+ORDER_DELIVERED = "delivered"
+ORDER_PARTIAL = "partial"
+ORDER_FAILED = "failed"
+ORDER_NO_BALANCE = "no_balance"
+ORDER_EXPIRED = "expired"
+ORDER_PAUSED = "paused"
+
+GIFT_PENDING = "pending"
+GIFT_SENT = "sent"
+GIFT_FAILED = "failed"
+
+RESUMABLE_ORDER_STATUSES = [
+    ORDER_PAUSED,
+    ORDER_QUEUED,
+    ORDER_DELIVERING,
+    ORDER_PARTIAL,
+    ORDER_FAILED,
+    ORDER_NO_BALANCE,
+]
+ACTIVE_ORDER_STATUSES = {ORDER_QUEUED, ORDER_DELIVERING, ORDER_DELIVERED}
+
+FLOOD_WAIT_ERRORS = {"FloodWait", "FloodPremiumWait", "SlowmodeWait"}
+
+STAGE_TITLES = {
+    "username": "ввод username",
+    "confirmed": "подтверждение",
+    "queued": "очередь",
+    "resolved": "поиск получателя",
+    "delivered": "отправка подарков",
+    "reported": "отчёт",
+}
+
+LOTS_PAGE_SIZE = 20
+MAX_LOT_STARS = 1_000_000
+CALLBACK_PREFIX = "sg:"
+
+USERNAME_RE = re.compile(r"[A-Za-z][A-Za-z0-9_]{2,30}[A-Za-z0-9]")
+USER_ID_RE = re.compile(r"[1-9]\d{4,14}")
+USER_LINK_RE = re.compile(
+    r"(?:https?://)?(?:(?:www\.)?(?:t\.me|telegram\.(?:me|dog))/@?([^/?#\s]+)"
+    r"|([A-Za-z0-9_]+)\.t\.me)/?(?:[?#]\S*)?",
+    re.IGNORECASE,
+)
+USERNAME_MISSING_ERRORS = {"UsernameNotOccupied", "UsernameInvalid", "PeerIdInvalid"}
+# Ошибки получателя: закэшированный peer устарел или неверен
+RECIPIENT_ERRORS = USERNAME_MISSING_ERRORS | {
+    "UserIdInvalid",
+    "UserDeactivated",
+    "UserDeactivatedBan",
+    "InputUserDeactivated",
+    "PeerIdNotSupported",
+}
+
+USERNAME_HINT = (
+    "❌ Не похоже на username Telegram.\n"
+    "Пример: @username, https://t.me/username или числовой ID"
+)
+
 CONFIRM_RESPONSES = {"+", "да", "yes", "верно", "confirm"}
 CANCEL_RESPONSES = {"-", "нет", "no"}
 
@@ -55,80 +224,2482 @@ logger.setLevel(logging.DEBUG)
 LOGGER_PREFIX = "[StarsGifter]"
 
 
-class StarsGifterPlugin:
-    def __init__(self) -> None:
-        self.config = self.load_config()
-        self.lot_stars_mapping = {
-            str(k): int(v) for k, v in self.config.get("lot_stars_mapping", {}).items()
-        }
-        self.random_gifts = {
-            int(k): v
-            for k, v in self.config.get("random_gifts", DEFAULT_CONFIG["random_gifts"]).items()
+def get_flood_wait(error: BaseException) -> Optional[int]:
+    """Длительность FloodWait в секундах, если ошибка — FloodWait Pyrogram"""
+    if not any(cls.__name__ in FLOOD_WAIT_ERRORS for cls in type(error).__mro__):
+        return None
+    value = getattr(error, "value", None)
+    if value is None:
+        value = getattr(error, "x", 0)
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return 0
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Кладёт запись в очередь как есть: форматирование — в потоке QueueListener"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class RepeatLimitFilter(logging.Filter):
+    """Не больше burst одинаковых предупреждений за interval секунд.
+
+    Одинаковыми считаются записи с общим шаблоном сообщения; о подавленных
+    повторах сообщает первая запись следующего окна. Ошибки (выше max_level)
+    не ограничиваются.
+    """
+
+    def __init__(
+        self,
+        interval: float = 60,
+        burst: int = 3,
+        min_level: int = logging.WARNING,
+        max_level: int = logging.WARNING,
+    ) -> None:
+        super().__init__()
+        self.interval = max(0.0, float(interval))
+        self.burst = max(1, int(burst))
+        self.min_level = min_level
+        self.max_level = max_level
+        self._windows: Dict[Tuple[int, str], List] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not self.min_level <= record.levelno <= self.max_level or not self.interval:
+            return True
+        key = (record.levelno, str(record.msg))
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window is not None else 0
+                self._windows[key] = [now, 1, 0]
+                if suppressed and isinstance(record.args, tuple):
+                    record.msg = f"{record.msg} (ещё %s подобных скрыто)"
+                    record.args = record.args + (suppressed,)
+                return True
+            window[1] += 1
+            if window[1] > self.burst:
+                window[2] += 1
+                return False
+            return True
+
+
+def setup_async_logging(
+    target: logging.Logger, repeat_interval: float = 60, repeat_burst: int = 3
+) -> Optional[logging.handlers.QueueListener]:
+    """Переводит логгер на очередь: обработчики родителей работают в фоновом потоке"""
+    handlers: List[logging.Handler] = []
+    current: Optional[logging.Logger] = target
+    while current is not None:
+        handlers.extend(
+            h for h in current.handlers if not isinstance(h, logging.handlers.QueueHandler)
+        )
+        if not current.propagate:
+            break
+        current = current.parent
+    if not handlers:
+        return None
+
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    handler = DeferredQueueHandler(log_queue)
+    handler.addFilter(RepeatLimitFilter(repeat_interval, repeat_burst))
+    for old in [h for h in target.handlers if isinstance(h, logging.handlers.QueueHandler)]:
+        target.removeHandler(old)
+    target.addHandler(handler)
+    target.propagate = False
+    listener.start()
+    return listener
+
+
+def stop_async_logging(
+    target: logging.Logger, listener: logging.handlers.QueueListener
+) -> None:
+    """Возвращает логгер к обычной записи через родителей"""
+    for handler in [h for h in target.handlers if isinstance(h, DeferredQueueHandler)]:
+        target.removeHandler(handler)
+    target.propagate = True
+    listener.stop()
+
+
+def normalize_username(text: str) -> Optional[str]:
+    """@username или числовой ID из ввода покупателя (@name, name, t.me/name); None — не похоже"""
+    value = text.strip().strip("«»\"'`.,;!")
+    link = USER_LINK_RE.fullmatch(value)
+    if link:
+        value = link.group(1) or link.group(2)
+    elif value.startswith("@"):
+        value = value[1:]
+    if USER_ID_RE.fullmatch(value):
+        return value
+    if USERNAME_RE.fullmatch(value):
+        return f"@{value}"
+    return None
+
+
+def telegram_peer(username: str) -> Union[int, str]:
+    """Аргумент для Pyrogram: ID — числом (строку из цифр Pyrogram считает телефоном)"""
+    return int(username) if USER_ID_RE.fullmatch(username) else username
+
+
+def is_username_missing(error: BaseException) -> bool:
+    """Telegram ответил, что такого пользователя нет"""
+    return any(cls.__name__ in USERNAME_MISSING_ERRORS for cls in type(error).__mro__)
+
+
+def is_recipient_error(error: BaseException) -> bool:
+    """Ошибка Telegram о получателе (PEER_ID_INVALID, USER_DEACTIVATED и т.п.)"""
+    return any(cls.__name__ in RECIPIENT_ERRORS for cls in type(error).__mro__)
+
+
+def is_gift_unavailable(error: BaseException) -> bool:
+    """Ошибка Telegram о самом подарке (STARGIFT_INVALID, STARGIFT_USAGE_LIMITED и т.п.)"""
+    return "STARGIFT" in str(getattr(error, "ID", "") or type(error).__name__).upper()
+
+
+def callback_data(action: str, *args: Any) -> str:
+    """callback_data кнопки панели: sg:<действие>[:<аргументы>]"""
+    return ":".join([CALLBACK_PREFIX + action, *(str(arg) for arg in args)])
+
+
+def parse_lot_table(text: str) -> Tuple[Dict[str, int], List[str]]:
+    """Разбор импорта лотов: JSON {lot_id: stars}, JSON-список или CSV «lot_id,stars».
+
+    Возвращает изменения (0 звёзд — удалить лот) и список ошибок по строкам.
+    """
+    text = text.lstrip("\ufeff").strip()
+    rows: List[Tuple[Any, Any]] = []
+    errors: List[str] = []
+    is_csv = text[:1] not in ("{", "[")
+    if not is_csv:
+        try:
+            data = json.loads(text)
+        except ValueError as e:
+            return {}, [f"JSON: {e}"]
+        if isinstance(data, dict):
+            rows = list(data.items())
+        else:
+            for item in data:
+                if isinstance(item, dict):
+                    rows.append((item.get("lot_id"), item.get("stars")))
+                elif isinstance(item, (list, tuple)) and len(item) >= 2:
+                    rows.append((item[0], item[1]))
+                else:
+                    rows.append((item, None))
+    else:
+        lines = text.splitlines()
+        head = lines[0] if lines else ""
+        delimiter = "\t" if "\t" in head else ";" if ";" in head and "," not in head else ","
+        rows = [
+            (row[0], row[1] if len(row) > 1 else None)
+            for row in csv.reader(lines, delimiter=delimiter)
+            if row and any(cell.strip() for cell in row)
+        ]
+
+    changes: Dict[str, int] = {}
+    for line, (lot_id, stars) in enumerate(rows, 1):
+        lot_id = str(lot_id if lot_id is not None else "").strip()
+        try:
+            stars = int(str(stars).strip())
+        except ValueError:
+            if not (is_csv and line == 1):
+                errors.append(f"{line}: {lot_id or '?'} — неверное число звёзд")
+            continue
+        if not lot_id or any(ch.isspace() for ch in lot_id) or stars < 0:
+            errors.append(f"{line}: {lot_id or '?'} — неверная строка")
+            continue
+        if stars > MAX_LOT_STARS:
+            errors.append(f"{line}: {lot_id} — больше {MAX_LOT_STARS}⭐")
+            continue
+        changes[lot_id] = stars
+    return changes, errors
+
+
+class LotIndex:
+    """Соответствие lot_id → звёзды в компактном виде.
+
+    Числовые lot_id (обычный случай на FunPay) лежат в двух отсортированных
+    массивах array — 12 байт на лот, поиск бинарный; остальные id — в словаре.
+    """
+
+    def __init__(self, mapping: Optional[Dict[str, int]] = None) -> None:
+        self._ids = array("q")
+        self._stars = array("I")
+        self._other: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        if mapping:
+            self.update(mapping)
+
+    @staticmethod
+    def _key(lot_id: Any) -> Optional[int]:
+        text = str(lot_id)
+        if text.isascii() and text.isdigit() and len(text) < 19 and str(int(text)) == text:
+            return int(text)
+        return None
+
+    @staticmethod
+    def _stars_value(stars: Any) -> int:
+        stars = int(stars)
+        if not 0 <= stars <= MAX_LOT_STARS:
+            raise ValueError(f"Число звёзд вне диапазона 0..{MAX_LOT_STARS}: {stars}")
+        return stars
+
+    def _find(self, key: int) -> int:
+        i = bisect_left(self._ids, key)
+        return i if i < len(self._ids) and self._ids[i] == key else -1
+
+    def get(self, lot_id: Any, default: Optional[int] = None) -> Optional[int]:
+        key = self._key(lot_id)
+        if key is None:
+            return self._other.get(str(lot_id), default)
+        with self._lock:
+            i = self._find(key)
+            return self._stars[i] if i >= 0 else default
+
+    def __getitem__(self, lot_id: Any) -> int:
+        stars = self.get(lot_id)
+        if stars is None:
+            raise KeyError(lot_id)
+        return stars
+
+    def __contains__(self, lot_id: Any) -> bool:
+        return self.get(lot_id) is not None
+
+    def __setitem__(self, lot_id: Any, stars: int) -> None:
+        stars = self._stars_value(stars)
+        key = self._key(lot_id)
+        if key is None:
+            self._other[str(lot_id)] = stars
+            return
+        with self._lock:
+            i = bisect_left(self._ids, key)
+            if i < len(self._ids) and self._ids[i] == key:
+                self._stars[i] = stars
+            else:
+                self._ids.insert(i, key)
+                self._stars.insert(i, stars)
+
+    def pop(self, lot_id: Any, default: Optional[int] = None) -> Optional[int]:
+        key = self._key(lot_id)
+        if key is None:
+            return self._other.pop(str(lot_id), default)
+        with self._lock:
+            i = self._find(key)
+            if i < 0:
+                return default
+            stars = self._stars[i]
+            del self._ids[i]
+            del self._stars[i]
+            return stars
+
+    def update(self, mapping: Dict[str, int], removed: Iterable[str] = ()) -> None:
+        """Массовое изменение: один проход с пересборкой массивов"""
+        numeric: Dict[int, int] = {}
+        other: Dict[str, int] = {}
+        drop = set()
+        for lot_id, stars in mapping.items():
+            key = self._key(lot_id)
+            if key is None:
+                other[str(lot_id)] = self._stars_value(stars)
+            else:
+                numeric[key] = self._stars_value(stars)
+        self._other.update(other)
+        for lot_id in removed:
+            key = self._key(lot_id)
+            if key is None:
+                self._other.pop(str(lot_id), None)
+            else:
+                drop.add(key)
+        if not numeric and not drop:
+            return
+        with self._lock:
+            merged = dict(zip(self._ids, self._stars))
+            merged.update(numeric)
+            for key in drop:
+                merged.pop(key, None)
+            keys = sorted(merged)
+            # Оба массива собираются заранее, чтобы ошибка не рассинхронизировала их
+            ids = array("q", keys)
+            stars = array("I", (merged[key] for key in keys))
+            self._ids, self._stars = ids, stars
+
+    def __len__(self) -> int:
+        return len(self._ids) + len(self._other)
+
+    def items(self) -> List[Tuple[str, int]]:
+        with self._lock:
+            items = [(str(key), stars) for key, stars in zip(self._ids, self._stars)]
+        return items + sorted(self._other.items())
+
+    def __iter__(self):
+        return iter([lot_id for lot_id, _ in self.items()])
+
+    def to_dict(self) -> Dict[str, int]:
+        return dict(self.items())
+
+    def page(
+        self, page: int, size: int, query: str = ""
+    ) -> Tuple[List[Tuple[str, int]], int, int]:
+        """Страница списка (с поиском по lot_id или числу звёзд): элементы, всего, номер"""
+        query = query.strip()
+        if query:
+            items = [
+                (lot_id, stars)
+                for lot_id, stars in self.items()
+                if query in lot_id or query == str(stars)
+            ]
+            total = len(items)
+        else:
+            items = None
+            total = len(self)
+        pages = max(1, -(-total // size))
+        page = min(max(0, page), pages - 1)
+        start = page * size
+        if items is not None:
+            return items[start : start + size], total, page
+        with self._lock:
+            numeric = [
+                (str(key), stars)
+                for key, stars in zip(
+                    self._ids[start : start + size], self._stars[start : start + size]
+                )
+            ]
+            count = len(self._ids)
+        if len(numeric) < size:
+            other = sorted(self._other.items())
+            numeric += other[max(0, start - count) : max(0, start - count) + size - len(numeric)]
+        return numeric, total, page
+
+
+class Metrics:
+    """Счётчики, гистограммы и поэтапные замеры времени заказов.
+
+    Этапы заказа отмечаются через trace(): длительность от предыдущей отметки
+    попадает в гистограмму starsgifter_stage_seconds{stage=...}.
+    """
+
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+    def __init__(self, max_traces: int = 10000, samples: int = 500) -> None:
+        self.max_traces = max_traces
+        self.samples = samples
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, Tuple], float] = {}
+        self._histograms: Dict[Tuple[str, Tuple], List] = {}
+        self._recent: Dict[Tuple[str, Tuple], Deque[float]] = {}
+        self._gauges: Dict[str, Callable[[], Any]] = {}
+        self._traces: "OrderedDict[str, Dict[str, float]]" = OrderedDict()
+
+    @staticmethod
+    def _key(name: str, labels: Dict[str, Any]) -> Tuple[str, Tuple]:
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, value: float = 1.0, **labels) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [[0] * len(self.BUCKETS), 0.0, 0]
+                self._recent[key] = deque(maxlen=self.samples)
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    hist[0][i] += 1
+            hist[1] += value
+            hist[2] += 1
+            self._recent[key].append(value)
+
+    def gauge(self, name: str, fn: Callable[[], Any]) -> None:
+        """fn возвращает число или список пар (метки, значение)"""
+        self._gauges[name] = fn
+
+    def trace(self, order_id: Optional[str], stage: str) -> None:
+        if order_id is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            trace = self._traces.get(str(order_id))
+            if trace is None:
+                self._traces[str(order_id)] = {"_start": now, "_last": now}
+                while len(self._traces) > self.max_traces:
+                    self._traces.popitem(last=False)
+                return
+            elapsed = now - trace["_last"]
+            trace["_last"] = now
+        self.observe("starsgifter_stage_seconds", elapsed, stage=stage)
+
+    def finish(self, order_id: Optional[str], status: str) -> None:
+        self.inc("starsgifter_orders_total", status=status)
+        if order_id is None:
+            return
+        with self._lock:
+            trace = self._traces.pop(str(order_id), None)
+        if trace is not None:
+            self.observe("starsgifter_order_seconds", time.monotonic() - trace["_start"])
+
+    def counter(self, name: str, **labels) -> float:
+        with self._lock:
+            if labels:
+                return self._counters.get(self._key(name, labels), 0.0)
+            return sum(v for (n, _), v in self._counters.items() if n == name)
+
+    def stage_summary(self) -> List[Tuple[str, int, float, float]]:
+        """[(этап, число замеров, p50, p95)] по последним замерам"""
+        result = []
+        with self._lock:
+            for (name, labels), values in self._recent.items():
+                if name != "starsgifter_stage_seconds" or not values:
+                    continue
+                ordered = sorted(values)
+                result.append(
+                    (
+                        dict(labels).get("stage", ""),
+                        self._histograms[(name, labels)][2],
+                        ordered[len(ordered) // 2],
+                        ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+                    )
+                )
+        return result
+
+    @staticmethod
+    def _labels(labels: Iterable[Tuple[str, Any]]) -> str:
+        parts = []
+        for key, value in labels:
+            value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+            parts.append(f'{key}="{value}"')
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> str:
+        """Текст в формате Prometheus exposition"""
+        lines: List[str] = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+        seen = set()
+        for (name, labels), value in counters:
+            if name not in seen:
+                lines.append(f"# TYPE {name} counter")
+                seen.add(name)
+            lines.append(f"{name}{self._labels(labels)} {value:g}")
+        for (name, labels), (buckets, total, count) in histograms:
+            if name not in seen:
+                lines.append(f"# TYPE {name} histogram")
+                seen.add(name)
+            for bound, bucket in zip(self.BUCKETS, buckets):
+                lines.append(f"{name}_bucket{self._labels(labels + (('le', bound),))} {bucket}")
+            lines.append(f"{name}_bucket{self._labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{self._labels(labels)} {total:g}")
+            lines.append(f"{name}_count{self._labels(labels)} {count}")
+        for name, fn in sorted(self._gauges.items()):
+            try:
+                value = fn()
+            except Exception:
+                continue
+            lines.append(f"# TYPE {name} gauge")
+            if isinstance(value, (int, float)):
+                lines.append(f"{name} {value:g}")
+                continue
+            for labels, item in value:
+                lines.append(f"{name}{self._labels(sorted(labels.items()))} {item:g}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsExporter:
+    """Выгрузка метрик: локальный HTTP /metrics и/или периодическая запись в файл"""
+
+    def __init__(
+        self,
+        metrics: Metrics,
+        http_host: str = "127.0.0.1",
+        http_port: int = 0,
+        file: str = "",
+        file_interval: float = 30,
+    ) -> None:
+        self.metrics = metrics
+        self.http_host = http_host
+        self.http_port = int(http_port or 0)
+        self.file = file
+        self.file_interval = max(1.0, float(file_interval))
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._stop = threading.Event()
+        self._writer: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self.http_port and self._server is None:
+            self._start_http()
+        if self.file and self._writer is None:
+            self._stop.clear()
+            self._writer = threading.Thread(
+                target=self._write_loop, name="StarsGifterMetrics", daemon=True
+            )
+            self._writer.start()
+
+    def _start_http(self) -> None:
+        metrics = self.metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args) -> None:
+                return
+
+        try:
+            self._server = ThreadingHTTPServer((self.http_host, self.http_port), Handler)
+        except OSError as e:
+            logger.error(
+                "%s ❌ Метрики: не удалось открыть порт %s: %s",
+                LOGGER_PREFIX, self.http_port, e,
+            )
+            return
+        self._server.daemon_threads = True
+        threading.Thread(
+            target=self._server.serve_forever, name="StarsGifterMetricsHTTP", daemon=True
+        ).start()
+        logger.info(
+            "%s 📈 Метрики: http://%s:%s/metrics",
+            LOGGER_PREFIX, self.http_host, self._server.server_port,
+        )
+
+    def write_file(self) -> None:
+        tmp = f"{self.file}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(self.metrics.render())
+        os.replace(tmp, self.file)
+
+    def _write_loop(self) -> None:
+        while not self._stop.wait(self.file_interval):
+            try:
+                self.write_file()
+            except OSError as e:
+                logger.error("%s ❌ Метрики: ошибка записи %s: %s", LOGGER_PREFIX, self.file, e)
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if self.file:
+            try:
+                self.write_file()
+            except OSError:
+                pass
+
+
+class AsyncLoopThread:
+    """Фоновый поток с собственным event loop, в котором живёт клиент Pyrogram"""
+
+    def __init__(self, name: str = "StarsGifterLoop") -> None:
+        self.name = name
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._started = threading.Event()
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        if self.is_running:
+            return
+        self.loop = asyncio.new_event_loop()
+        self._started.clear()
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+        self._started.wait()
+
+    def _run(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        self.loop.call_soon(self._started.set)
+        try:
+            self.loop.run_forever()
+        finally:
+            pending = asyncio.all_tasks(self.loop)
+            for task in pending:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            self.loop.close()
+
+    def submit(self, coro) -> concurrent.futures.Future:
+        """Запланировать корутину в loop из любого потока"""
+        if not self.is_running:
+            coro.close()
+            raise RuntimeError("Event loop StarsGifter не запущен")
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout: Optional[float] = None):
+        """Выполнить корутину в loop и дождаться результата"""
+        return self.submit(coro).result(timeout)
+
+    def stop(self, timeout: float = 5.0) -> None:
+        if not self.is_running:
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout)
+
+
+class AdaptiveRateLimiter:
+    """Token bucket для send_gift, общий для всех доставок.
+
+    Скорость растёт на каждом успешном вызове и уменьшается вдвое на FloodWait,
+    а сам FloodWait приостанавливает выдачу токенов на указанное Telegram время.
+    """
+
+    def __init__(
+        self,
+        rate: float = 0.5,
+        burst: int = 2,
+        min_rate: float = 0.1,
+        max_rate: float = 3.0,
+        increase: float = 0.05,
+        decrease: float = 0.5,
+    ) -> None:
+        self.min_rate = float(min_rate)
+        self.max_rate = max(float(max_rate), self.min_rate)
+        self.rate = min(max(float(rate), self.min_rate), self.max_rate)
+        self.burst = max(1, int(burst))
+        self.increase = increase
+        self.decrease = decrease
+        self.tokens = float(self.burst)
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.flood_waits = 0
+        self._lock: Optional[asyncio.Lock] = None
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self) -> None:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        # Lock выдаёт токены ожидающим по очереди (FIFO)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def on_success(self) -> None:
+        self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_flood_wait(self, seconds: float) -> None:
+        now = time.monotonic()
+        self.flood_waits += 1
+        self.paused_until = max(self.paused_until, now + seconds)
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+        self.tokens = 0.0
+        self.updated_at = max(now, self.paused_until)
+
+    @property
+    def paused_for(self) -> float:
+        return max(0.0, self.paused_until - time.monotonic())
+
+
+class GiftPlanner:
+    """Разложение суммы на минимальное число подарков.
+
+    Номиналы берутся из ключей random_gifts. Таблица минимального числа подарков
+    строится один раз динамикой до max_amount, после чего каждый заказ
+    отвечается поиском в таблице.
+    """
+
+    def __init__(self, denominations, max_amount: int = 10000) -> None:
+        self.denominations = sorted({int(d) for d in denominations if int(d) > 0}, reverse=True)
+        # Таблица должна вмещать крупнейший номинал, иначе добор уходит в минус
+        self.max_amount = max(0, int(max_amount), *self.denominations[:1])
+        self._counts: List[int] = []
+        self._last: List[int] = []
+        self._plans: Dict[int, Dict[int, int]] = {}
+        self._build()
+
+    def _build(self) -> None:
+        impossible = self.max_amount + 1
+        counts = [0] + [impossible] * self.max_amount
+        last = [0] * (self.max_amount + 1)
+        for amount in range(1, self.max_amount + 1):
+            best, best_d = impossible, 0
+            for d in self.denominations:
+                if d <= amount and counts[amount - d] + 1 < best:
+                    best, best_d = counts[amount - d] + 1, d
+            counts[amount] = best
+            last[amount] = best_d
+        self._counts = counts
+        self._last = last
+
+    def count(self, amount: int) -> Optional[int]:
+        """Минимальное число подарков для суммы или None"""
+        plan = self.plan(amount)
+        return sum(plan.values()) if plan is not None else None
+
+    def plan(self, amount: int) -> Optional[Dict[int, int]]:
+        """{номинал: количество} с минимальным числом подарков или None"""
+        if amount <= 0 or not self.denominations:
+            return None
+        cached = self._plans.get(amount)
+        if cached is not None:
+            return dict(cached)
+
+        plan: Dict[int, int] = {}
+        rest = amount
+        if rest > self.max_amount:
+            # За пределами таблицы добираем крупнейшим номиналом: остаток, который
+            # влезает в таблицу и даёт меньше всего подарков
+            largest = self.denominations[0]
+            extra = -(-(rest - self.max_amount) // largest)
+            best = None
+            while rest - extra * largest >= 0 and (best is None or extra < best[0]):
+                count = self._counts[rest - extra * largest]
+                if count <= self.max_amount and (best is None or extra + count < best[0]):
+                    best = (extra + count, extra)
+                extra += 1
+            if best is None:
+                return None
+            plan[largest] = best[1]
+            rest -= best[1] * largest
+        if rest < 0 or self._counts[rest] > self.max_amount:
+            return None
+        while rest > 0:
+            d = self._last[rest]
+            plan[d] = plan.get(d, 0) + 1
+            rest -= d
+
+        self._plans[amount] = plan
+        return dict(plan)
+
+
+class GiftCatalog:
+    """Каталог подарков Telegram: id, цена и доступность.
+
+    Обновляется через get_available_gifts не чаще раза в ttl секунд и
+    хранится на диске, чтобы после перезапуска не ждать первого запроса.
+    Лимитированные подарки по умолчанию не используются.
+    """
+
+    def __init__(self, path: str, ttl: float = 3600, include_limited: bool = False) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.include_limited = include_limited
+        self.gifts: Dict[int, Dict] = {}
+        self.fetched_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.fetched_at if self.fetched_at else float("inf")
+
+    @property
+    def expires_in(self) -> float:
+        return self.ttl - self.age
+
+    @property
+    def is_fresh(self) -> bool:
+        return self.expires_in > 0
+
+    def load(self) -> bool:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            gifts = {int(g["id"]): g for g in data.get("gifts", [])}
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+        with self._lock:
+            self.gifts = gifts
+            self.fetched_at = float(data.get("fetched_at", 0))
+        return True
+
+    def save(self) -> None:
+        with self._lock:
+            data = {"fetched_at": self.fetched_at, "gifts": list(self.gifts.values())}
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+    @staticmethod
+    def parse(gift: Any) -> Optional[Dict]:
+        gift_id = getattr(gift, "id", None)
+        price = getattr(gift, "price", None) or getattr(gift, "star_count", None)
+        if gift_id is None or not price:
+            return None
+        limited = bool(getattr(gift, "is_limited", False))
+        remaining = getattr(gift, "available_amount", None)
+        if remaining is None:
+            remaining = getattr(gift, "remaining_count", None)
+        sold_out = bool(getattr(gift, "is_sold_out", False)) or (limited and remaining == 0)
+        return {"id": int(gift_id), "price": int(price), "limited": limited, "sold_out": sold_out}
+
+    async def refresh(self, client: "Client") -> int:
+        raw = await client.get_available_gifts()
+        gifts = {}
+        for gift in raw or []:
+            parsed = self.parse(gift)
+            if parsed is not None:
+                gifts[parsed["id"]] = parsed
+        if not gifts:
+            raise RuntimeError("пустой каталог")
+        with self._lock:
+            self.gifts = gifts
+            self.fetched_at = time.time()
+        return len(gifts)
+
+    def discard(self, gift_id: int) -> None:
+        with self._lock:
+            gift = self.gifts.get(gift_id)
+            if gift is not None:
+                gift["sold_out"] = True
+
+    def usable(self) -> Dict[int, List[int]]:
+        """{цена: [id]} подарков, которые сейчас можно отправить"""
+        result: Dict[int, List[int]] = {}
+        with self._lock:
+            for gift in self.gifts.values():
+                if gift["sold_out"] or (gift["limited"] and not self.include_limited):
+                    continue
+                result.setdefault(gift["price"], []).append(gift["id"])
+        return {price: sorted(ids) for price, ids in result.items()}
+
+    def merge(self, configured: Dict[int, List[int]]) -> Dict[int, List[int]]:
+        """Номиналы из каталога; если в конфиге для цены есть действующие id — берутся они"""
+        result = {}
+        for price, ids in self.usable().items():
+            valid = set(ids)
+            preferred = [gift_id for gift_id in configured.get(price, []) if gift_id in valid]
+            result[price] = preferred or ids
+        return result
+
+
+class ConfigFile:
+    """JSON-конфиг плагина: атомарная отложенная запись и слежение за правками.
+
+    Сохранения в пределах save_delay склеиваются в одну запись (временный
+    файл + os.replace), изменения файла на диске замечаются по mtime.
+    """
+
+    def __init__(self, path: str, defaults: Dict) -> None:
+        self.path = path
+        self.defaults = defaults
+        self.save_delay = 0.0
+        self.reload_interval = 5.0
+        self.on_change: Optional[Callable[[Dict], None]] = None
+        self.saves = 0
+        self._signature: Optional[Tuple[int, int]] = None
+        self._pending: Optional[Dict] = None
+        self._due = 0.0
+        self._lock = threading.RLock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _stat(self) -> Optional[Tuple[int, int]]:
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def load(self) -> Dict:
+        with self._lock:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            if not os.path.exists(self.path):
+                self.write(self.defaults)
+            signature = self._stat()
+            with open(self.path, "r", encoding="utf-8") as f:
+                cfg = json.load(f)
+            self._signature = signature
+            return cfg
+
+    def write(self, cfg: Dict) -> None:
+        with self._lock:
+            text = json.dumps(cfg, indent=4, ensure_ascii=False)
+            tmp = f"{self.path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(text)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+            self._signature = self._stat()
+            self.saves += 1
+
+    def save(self, cfg: Dict) -> None:
+        """Запланировать запись; вызовы до её выполнения склеиваются в одну"""
+        with self._lock:
+            if self._pending is None:
+                self._due = time.monotonic() + self.save_delay
+            self._pending = cfg
+        if self._thread is None:
+            self.flush()
+        else:
+            self._wakeup.set()
+
+    @property
+    def pending(self) -> bool:
+        return self._pending is not None
+
+    def flush(self) -> bool:
+        with self._lock:
+            cfg = self._pending
+            if cfg is None:
+                return False
+            self._pending = None
+            try:
+                self.write(cfg)
+            except (OSError, RuntimeError, TypeError, ValueError) as e:
+                self._pending = cfg
+                self._due = time.monotonic() + max(self.save_delay, 1.0)
+                logger.error("%s ❌ Ошибка сохранения конфига: %s", LOGGER_PREFIX, e)
+                return False
+        return True
+
+    def changed(self) -> bool:
+        signature = self._stat()
+        return signature is not None and signature != self._signature
+
+    def reload(self) -> bool:
+        with self._lock:
+            if self._pending is not None or not self.changed():
+                return False
+            try:
+                cfg = self.load()
+            except (OSError, ValueError) as e:
+                self._signature = self._stat()
+                logger.error("%s ❌ Конфиг не прочитан: %s", LOGGER_PREFIX, e)
+                return False
+        if self.on_change is not None:
+            try:
+                self.on_change(cfg)
+            except Exception as e:
+                logger.error("%s ❌ Конфиг не применён: %s", LOGGER_PREFIX, e)
+                return False
+        logger.info("%s 🔄 Конфиг перечитан с диска", LOGGER_PREFIX)
+        return True
+
+    def start(
+        self,
+        on_change: Callable[[Dict], None],
+        save_delay: float = 1.0,
+        reload_interval: float = 5.0,
+    ) -> None:
+        self.on_change = on_change
+        self.save_delay = max(0.0, float(save_delay))
+        self.reload_interval = max(0.5, float(reload_interval))
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="StarsGifterConfig", daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        next_check = time.monotonic() + self.reload_interval
+        while not self._stop.is_set():
+            now = time.monotonic()
+            with self._lock:
+                due = self._due if self._pending is not None else None
+            if due is not None and due <= now:
+                self.flush()
+                continue
+            if next_check <= now:
+                self.reload()
+                next_check = now + self.reload_interval
+                continue
+            deadline = next_check if due is None else min(due, next_check)
+            self._wakeup.wait(deadline - now)
+            self._wakeup.clear()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        self.flush()
+
+
+class OrderStore:
+    """Хранилище диалогов, заказов и прогресса доставки (SQLite в режиме WAL).
+
+    Записи копятся в открытой транзакции и коммитятся пачкой: при достижении
+    batch_size, фоновым потоком раз в flush_interval или по sync=True.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS states (
+            chat_id INTEGER NOT NULL,
+            buyer_id INTEGER NOT NULL,
+            state TEXT NOT NULL,
+            data TEXT NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (chat_id, buyer_id)
+        );
+        CREATE TABLE IF NOT EXISTS orders (
+            order_id TEXT PRIMARY KEY,
+            chat_id INTEGER,
+            username TEXT,
+            stars_count INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_orders_status ON orders (status, updated_at);
+        CREATE TABLE IF NOT EXISTS gifts (
+            order_id TEXT NOT NULL,
+            gift_index INTEGER NOT NULL,
+            price INTEGER NOT NULL,
+            gift_id INTEGER,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (order_id, gift_index)
+        );
+    """
+
+    def __init__(self, path: str, batch_size: int = 50, flush_interval: float = 1.0) -> None:
+        self.path = path
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = max(0.05, float(flush_interval))
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.RLock()
+        self._dirty = 0
+        self._stop = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            with self._lock:
+                if self._conn is None:
+                    directory = os.path.dirname(self.path)
+                    if directory:
+                        os.makedirs(directory, exist_ok=True)
+                    conn = sqlite3.connect(self.path, check_same_thread=False)
+                    conn.row_factory = sqlite3.Row
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    conn.execute("PRAGMA synchronous=NORMAL")
+                    conn.executescript(self.SCHEMA)
+                    conn.commit()
+                    self._conn = conn
+                    self._stop.clear()
+                    self._flusher = threading.Thread(
+                        target=self._flush_loop, name="StarsGifterStore", daemon=True
+                    )
+                    self._flusher.start()
+        return self._conn
+
+    def _flush_loop(self) -> None:
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                logger.error("%s ❌ Ошибка записи состояния: %s", LOGGER_PREFIX, e)
+
+    def _write(self, sql: str, params: Tuple = (), sync: bool = False) -> None:
+        with self._lock:
+            self.conn.execute(sql, params)
+            self._dirty += 1
+            if sync or self._dirty >= self.batch_size:
+                self._commit()
+
+    def _write_many(self, sql: str, rows: List[Tuple], sync: bool = False) -> None:
+        with self._lock:
+            self.conn.executemany(sql, rows)
+            self._dirty += len(rows)
+            if sync or self._dirty >= self.batch_size:
+                self._commit()
+
+    def _query(self, sql: str, params: Tuple = ()) -> List[sqlite3.Row]:
+        with self._lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def _commit(self) -> None:
+        self.conn.commit()
+        self._dirty = 0
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._conn is not None and self._dirty:
+                self._commit()
+
+    def close(self) -> None:
+        self._stop.set()
+        with self._lock:
+            if self._conn is None:
+                return
+            self._commit()
+            self._conn.close()
+            self._conn = None
+
+    # Диалоги
+
+    def save_state(self, key: Tuple[int, int], state: Dict) -> None:
+        self._write(
+            "INSERT OR REPLACE INTO states (chat_id, buyer_id, state, data, updated_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (key[0], key[1], state["state"], json.dumps(state["data"], ensure_ascii=False), time.time()),
+        )
+
+    def delete_state(self, key: Tuple[int, int]) -> None:
+        self._write("DELETE FROM states WHERE chat_id = ? AND buyer_id = ?", key)
+
+    def load_states(self) -> Dict[Tuple[int, int], Dict]:
+        rows = self._query("SELECT chat_id, buyer_id, state, data, updated_at FROM states")
+        return {
+            (row["chat_id"], row["buyer_id"]): {
+                "state": row["state"],
+                "data": json.loads(row["data"]),
+                "updated_at": row["updated_at"],
+            }
+            for row in rows
         }
-        self.running = self.config.get("plugin_enabled", True)
-        self.pyrogram_client: Optional["Client"] = None
-        self.funpay_states: Dict[Tuple[int, int], Dict] = {}
+
+    # Заказы
+
+    def save_order(
+        self,
+        order_id: str,
+        chat_id: int,
+        stars_count: int,
+        status: str,
+        username: Optional[str] = None,
+    ) -> None:
+        now = time.time()
+        self._write(
+            "INSERT INTO orders (order_id, chat_id, username, stars_count, status, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (order_id) DO UPDATE SET chat_id = excluded.chat_id, "
+            "username = COALESCE(excluded.username, orders.username), "
+            "stars_count = excluded.stars_count, status = excluded.status, "
+            "updated_at = excluded.updated_at",
+            (str(order_id), chat_id, username, stars_count, status, now, now),
+        )
+
+    def set_order_status(self, order_id: str, status: str, sync: bool = False) -> None:
+        self._write(
+            "UPDATE orders SET status = ?, updated_at = ? WHERE order_id = ?",
+            (status, time.time(), str(order_id)),
+            sync=sync,
+        )
+
+    def get_order(self, order_id: str) -> Optional[Dict]:
+        rows = self._query("SELECT * FROM orders WHERE order_id = ?", (str(order_id),))
+        return dict(rows[0]) if rows else None
+
+    def list_orders(self, statuses: List[str], limit: int = 50) -> List[Dict]:
+        placeholders = ", ".join("?" for _ in statuses)
+        rows = self._query(
+            f"SELECT * FROM orders WHERE status IN ({placeholders}) ORDER BY updated_at LIMIT ?",
+            (*statuses, limit),
+        )
+        return [dict(row) for row in rows]
+
+    # Подарки заказа
+
+    def save_gift_plan(self, order_id: str, items: List[Tuple[int, int]]) -> None:
+        now = time.time()
+        self._write_many(
+            "INSERT OR IGNORE INTO gifts (order_id, gift_index, price, status, updated_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(str(order_id), index, price, GIFT_PENDING, now) for index, price in items],
+            sync=True,
+        )
+
+    def replace_pending_gifts(self, order_id: str, items: List[Tuple[int, int]]) -> None:
+        """Заменить неотправленные подарки заказа новым планом (отправленные не трогаются)"""
+        with self._lock:
+            self._write(
+                "DELETE FROM gifts WHERE order_id = ? AND status != ?", (str(order_id), GIFT_SENT)
+            )
+            self.save_gift_plan(order_id, items)
+
+    def mark_gift(
+        self,
+        order_id: str,
+        gift_index: int,
+        status: str,
+        gift_id: Optional[int] = None,
+        error: Optional[str] = None,
+        sync: bool = False,
+    ) -> None:
+        self._write(
+            "UPDATE gifts SET status = ?, gift_id = COALESCE(?, gift_id), error = ?, "
+            "attempts = attempts + 1, updated_at = ? WHERE order_id = ? AND gift_index = ?",
+            (status, gift_id, error, time.time(), str(order_id), gift_index),
+            sync=sync,
+        )
+
+    def get_gifts(self, order_id: str) -> List[Dict]:
+        rows = self._query(
+            "SELECT * FROM gifts WHERE order_id = ? ORDER BY gift_index", (str(order_id),)
+        )
+        return [dict(row) for row in rows]
+
+
+class OutboundMessageQueue:
+    """Фоновая отправка сообщений FunPay.
+
+    Сообщения одному чату, пришедшие в пределах coalesce_window, склеиваются
+    в одно; временные ошибки повторяются с нарастающей паузой.
+    """
+
+    def __init__(
+        self,
+        coalesce_window: float = 0.5,
+        max_length: int = 2000,
+        retries: int = 3,
+        retry_backoff: float = 1.0,
+    ) -> None:
+        self.coalesce_window = max(0.0, float(coalesce_window))
+        self.max_length = max(1, int(max_length))
+        self.retries = max(0, int(retries))
+        self.retry_backoff = float(retry_backoff)
+        self.sent = 0
+        self.merged = 0
+        self.failed = 0
+        self._queue: "queue.Queue[Tuple[Cardinal, int, str]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._start_lock = threading.Lock()
+
+    def start(self) -> None:
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="StarsGifterOutbound", daemon=True)
+            self._thread.start()
+
+    def send(self, cardinal: "Cardinal", chat_id: int, text: str) -> None:
+        """Поставить сообщение в очередь, не дожидаясь отправки"""
+        self._queue.put((cardinal, chat_id, text))
+        self.start()
+
+    @property
+    def pending(self) -> int:
+        return self._queue.unfinished_tasks
+
+    def _run(self) -> None:
+        while not self._stop.is_set() or not self._queue.empty():
+            try:
+                batch = [self._queue.get(timeout=0.5)]
+            except queue.Empty:
+                continue
+            deadline = time.monotonic() + self.coalesce_window
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                for cardinal, chat_id, text in self._merge(batch):
+                    self._deliver(cardinal, chat_id, text)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _merge(self, batch: List[Tuple["Cardinal", int, str]]) -> List[Tuple["Cardinal", int, str]]:
+        chats: Dict[Tuple[int, int], List[str]] = OrderedDict()
+        cardinals: Dict[Tuple[int, int], "Cardinal"] = {}
+        for cardinal, chat_id, text in batch:
+            key = (id(cardinal), chat_id)
+            cardinals[key] = cardinal
+            chunks = chats.setdefault(key, [])
+            if chunks and len(chunks[-1]) + len(text) + 2 <= self.max_length:
+                chunks[-1] += "\n\n" + text
+                self.merged += 1
+            else:
+                chunks.append(text)
+        return [
+            (cardinals[key], key[1], text) for key, chunks in chats.items() for text in chunks
+        ]
+
+    def _deliver(self, cardinal: "Cardinal", chat_id: int, text: str) -> None:
+        for attempt in range(self.retries + 1):
+            try:
+                cardinal.account.send_message(chat_id, text)
+                self.sent += 1
+                return
+            except Exception as e:
+                if attempt >= self.retries:
+                    self.failed += 1
+                    logger.error(
+                        "%s ❌ Сообщение в чат %s не отправлено: %s",
+                        LOGGER_PREFIX, chat_id, e,
+                    )
+                    return
+                logger.warning(
+                    "%s ⚠️ Ошибка отправки в чат %s (попытка %s/%s): %s",
+                    LOGGER_PREFIX, chat_id, attempt + 1, self.retries + 1, e,
+                )
+                time.sleep(self.retry_backoff * 2**attempt)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Дождаться отправки всех сообщений из очереди"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self.flush(timeout)
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+
+class StarsBalance:
+    """Кэш баланса звёзд аккаунта и резервы под подтверждённые заказы.
+
+    Пока баланс неизвестен (клиент не умеет get_stars_balance или ещё не
+    обновлялся), резервирование всегда проходит.
+    """
+
+    def __init__(self) -> None:
+        self.balance: Optional[int] = None
+        self.updated_at: Optional[float] = None
+        self.reservations: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def reserved(self) -> int:
+        with self._lock:
+            return sum(self.reservations.values())
+
+    @property
+    def available(self) -> Optional[int]:
+        with self._lock:
+            if self.balance is None:
+                return None
+            return self.balance - sum(self.reservations.values())
+
+    def update(self, balance: int) -> None:
+        with self._lock:
+            self.balance = int(balance)
+            self.updated_at = time.time()
+
+    def reserve(self, order_id: str, stars: int) -> bool:
+        """Зарезервировать звёзды под заказ; False, если баланса не хватает"""
+        with self._lock:
+            if order_id in self.reservations:
+                return True
+            if self.balance is not None:
+                if self.balance - sum(self.reservations.values()) < stars:
+                    return False
+            self.reservations[order_id] = stars
+            return True
+
+    def is_reserved(self, order_id: str) -> bool:
+        with self._lock:
+            return order_id in self.reservations
+
+    def consume(self, order_id: Optional[str], stars: int) -> None:
+        """Учесть отправленный подарок до следующего обновления баланса"""
+        with self._lock:
+            if self.balance is not None:
+                self.balance -= stars
+            if order_id in self.reservations:
+                self.reservations[order_id] = max(0, self.reservations[order_id] - stars)
+
+    def release(self, order_id: str) -> int:
+        with self._lock:
+            return self.reservations.pop(order_id, 0)
+
+
+class RecipientCache:
+    """LRU-кэш username → пользователь Telegram с ограниченным временем жизни.
+
+    Одновременные запросы одного username объединяются в один вызов get_users.
+    Используется только из loop-потока Pyrogram.
+    """
+
+    def __init__(self, max_size: int = 1000, ttl: float = 3600) -> None:
+        self.max_size = max(1, int(max_size))
+        self.ttl = float(ttl)
+        self.hits = 0
+        self.misses = 0
+        self._items: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._pending: Dict[str, asyncio.Future] = {}
 
     @staticmethod
-    def load_config() -> Dict:
-        os.makedirs(os.path.dirname(CONFIG_FILE), exist_ok=True)
-        if not os.path.exists(CONFIG_FILE):
-            with open(CONFIG_FILE, "w", encoding="utf-8") as f:
-                json.dump(DEFAULT_CONFIG, f, indent=4, ensure_ascii=False)
-        with open(CONFIG_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
+    def normalize(username: str) -> str:
+        return str(username).strip().lstrip("@").lower()
+
+    def get(self, username: str) -> Optional[Any]:
+        key = self.normalize(username)
+        item = self._items.get(key)
+        if item is None:
+            return None
+        expires_at, user = item
+        if expires_at < time.monotonic():
+            del self._items[key]
+            return None
+        self._items.move_to_end(key)
+        return user
+
+    def put(self, username: str, user: Any) -> None:
+        key = self.normalize(username)
+        self._items[key] = (time.monotonic() + self.ttl, user)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def invalidate(self, username: str) -> None:
+        self._items.pop(self.normalize(username), None)
+
+    async def resolve(
+        self, username: str, fetch: Callable[[str], Awaitable[Optional[Any]]]
+    ) -> Optional[Any]:
+        user = self.get(username)
+        if user is not None:
+            self.hits += 1
+            return user
+
+        key = self.normalize(username)
+        pending = self._pending.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        self.misses += 1
+        pending = asyncio.ensure_future(fetch(username))
+        self._pending[key] = pending
+        try:
+            user = await asyncio.shield(pending)
+        finally:
+            self._pending.pop(key, None)
+        if user is not None:
+            self.put(username, user)
+        return user
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+class SenderAccount:
+    """Аккаунт-отправитель: клиент Pyrogram со своим лимитером, балансом и кэшем получателей"""
+
+    def __init__(
+        self,
+        name: str,
+        settings: Dict,
+        rate_limiter: AdaptiveRateLimiter,
+        recipients: RecipientCache,
+    ) -> None:
+        self.name = name
+        self.settings = settings
+        self.client: Optional["Client"] = None
+        self.rate_limiter = rate_limiter
+        self.recipients = recipients
+        self.balance = StarsBalance()
+        self.connecting = False
+        self.cooldown_until = 0.0
+        self.consecutive_errors = 0
+        self.gifts_sent = 0
+
+    @property
+    def is_configured(self) -> bool:
+        return bool(self.settings.get("api_id") and self.settings.get("api_hash"))
+
+    @property
+    def is_connected(self) -> bool:
+        return self.client is not None and self.client.is_connected
+
+    @property
+    def is_usable(self) -> bool:
+        """Аккаунт подключён или может подключиться"""
+        return self.is_configured or self.client is not None
+
+    @property
+    def is_ready(self) -> bool:
+        return self.is_connected and self.cooldown_until <= time.monotonic()
+
+    def spare_budget(self) -> float:
+        """Сколько подарков аккаунт может отправить в ближайшую секунду"""
+        limiter = self.rate_limiter
+        if limiter.paused_for > 0:
+            return 0.0
+        elapsed = max(0.0, time.monotonic() - limiter.updated_at)
+        return min(limiter.burst, limiter.tokens + elapsed * limiter.rate) + limiter.rate
+
+    def covers(self, stars: int) -> bool:
+        available = self.balance.available
+        return available is None or available >= stars
+
+    def record_success(self) -> None:
+        self.consecutive_errors = 0
+        self.gifts_sent += 1
+
+    def record_error(self, flood_wait: Optional[int], threshold: int, cooldown: float) -> None:
+        now = time.monotonic()
+        if flood_wait is not None:
+            self.cooldown_until = max(self.cooldown_until, now + flood_wait)
+            return
+        self.consecutive_errors += 1
+        if self.consecutive_errors >= threshold:
+            self.consecutive_errors = 0
+            self.cooldown_until = max(self.cooldown_until, now + cooldown)
+            logger.warning(
+                "%s ⚠️ Аккаунт %s отключён на %.0f с",
+                LOGGER_PREFIX, self.name, cooldown,
+            )
+
+    async def fetch_user(self, username: str) -> Optional[Any]:
+        users = await self.client.get_users([telegram_peer(username)])
+        return users[0] if users else None
+
+    async def resolve(self, username: str) -> Optional[Any]:
+        """Пользователь Telegram по username (peer у каждого аккаунта свой)"""
+        return await self.recipients.resolve(username, self.fetch_user)
+
+
+class SenderPool:
+    """Аккаунты-отправители и распределение заказов между ними.
+
+    Заказ закрепляется за аккаунтом при резервировании звёзд: выбирается
+    доступный аккаунт с достаточным балансом и наибольшим запасом по лимиту.
+    Если аккаунт ушёл во FloodWait или сыпет ошибками, оставшиеся подарки
+    заказа переезжают на другой.
+    """
+
+    def __init__(self) -> None:
+        self.accounts: List[SenderAccount] = []
+        self.assignments: Dict[str, SenderAccount] = {}
+        self._lock = threading.RLock()
+
+    @property
+    def primary(self) -> Optional[SenderAccount]:
+        return self.accounts[0] if self.accounts else None
+
+    def add(self, account: SenderAccount) -> None:
+        self.accounts.append(account)
+
+    @property
+    def any_connected(self) -> bool:
+        return any(a.is_connected for a in self.accounts)
+
+    @property
+    def available(self) -> Optional[int]:
+        known = [a.balance.available for a in self.accounts if a.balance.available is not None]
+        return sum(known) if known else None
+
+    @property
+    def reserved(self) -> int:
+        return sum(a.balance.reserved for a in self.accounts)
 
     @staticmethod
-    def save_config(cfg: Dict) -> None:
-        with open(CONFIG_FILE, "w", encoding="utf-8") as f:
-            json.dump(cfg, f, indent=4, ensure_ascii=False)
+    def _rank(account: SenderAccount) -> Tuple[bool, float]:
+        # Запас по лимиту делится между уже закреплёнными за аккаунтом заказами
+        load = 1 + len(account.balance.reservations)
+        return account.is_ready, account.spare_budget() / load
+
+    def best(self, stars: int = 0) -> Optional[SenderAccount]:
+        """Подключённый аккаунт с наибольшим запасом по лимиту"""
+        candidates = [a for a in self.accounts if a.is_connected and a.covers(stars)]
+        return max(candidates, key=self._rank, default=None)
+
+    def has_alternative(self, account: SenderAccount) -> bool:
+        return any(a is not account and a.is_ready for a in self.accounts)
+
+    def reserve(self, order_id: str, stars: int) -> bool:
+        """Закрепить заказ за аккаунтом и зарезервировать звёзды"""
+        with self._lock:
+            if order_id in self.assignments:
+                return True
+            candidates = [a for a in self.accounts if a.is_usable and a.covers(stars)]
+            account = max(candidates, key=self._rank, default=None)
+            if account is None or not account.balance.reserve(order_id, stars):
+                return False
+            self.assignments[order_id] = account
+            return True
+
+    def is_reserved(self, order_id: str) -> bool:
+        with self._lock:
+            return order_id in self.assignments
+
+    @property
+    def has_usable(self) -> bool:
+        return any(a.is_usable for a in self.accounts)
+
+    def account_for(self, order_id: Optional[str], stars: int) -> Optional[SenderAccount]:
+        """Аккаунт для следующего подарка заказа, с переключением при недоступности"""
+        with self._lock:
+            current = self.assignments.get(order_id) if order_id else None
+            if current is not None and current.is_ready:
+                return current
+            alternatives = [
+                a for a in self.accounts if a is not current and a.is_ready and a.covers(stars)
+            ]
+            account = max(alternatives, key=self._rank, default=None)
+            if account is None:
+                return current or self.best()
+            if order_id:
+                if current is not None:
+                    current.balance.release(order_id)
+                    logger.info(
+                        "%s 🔀 Заказ #%s: %s → %s",
+                        LOGGER_PREFIX, order_id, current.name, account.name,
+                    )
+                account.balance.reserve(order_id, stars)
+                self.assignments[order_id] = account
+            return account
+
+    def release(self, order_id: str) -> None:
+        with self._lock:
+            account = self.assignments.pop(order_id, None)
+            if account is not None:
+                account.balance.release(order_id)
+
+
+class StateExpiry:
+    """Сроки диалогов: куча (срок, версия, ключ, действие) с ленивым удалением.
+
+    Обновление диалога кладёт новую запись, прежние записи ключа пропускаются
+    по версии, так что разбор наступивших сроков стоит O(k log n), без обхода
+    всех диалогов. Не потокобезопасно — вызывается под блокировкой владельца.
+    """
+
+    def __init__(self) -> None:
+        self._heap: List[Tuple[float, int, Tuple[int, int], str]] = []
+        self._versions: Dict[Tuple[int, int], int] = {}
+        self._seq = 0
+
+    def schedule(self, key: Tuple[int, int], at: float, action: str) -> None:
+        self._seq += 1
+        self._versions[key] = self._seq
+        heapq.heappush(self._heap, (at, self._seq, key, action))
+        if len(self._heap) > 2 * len(self._versions) + 64:
+            self._heap = [item for item in self._heap if self._versions.get(item[2]) == item[1]]
+            heapq.heapify(self._heap)
+
+    def discard(self, key: Tuple[int, int]) -> None:
+        self._versions.pop(key, None)
+
+    def pop_due(self, now: float) -> List[Tuple[Tuple[int, int], str]]:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            _, seq, key, action = heapq.heappop(self._heap)
+            if self._versions.get(key) == seq:
+                del self._versions[key]
+                due.append((key, action))
+        return due
+
+    def __len__(self) -> int:
+        return len(self._versions)
+
+
+class DeliveryInterrupted(Exception):
+    """Доставка прервана остановкой плагина до отправки очередного подарка"""
+
+
+class DeliveryJob:
+    """Заказ в очереди доставки"""
+
+    def __init__(
+        self,
+        cardinal: "Cardinal",
+        username: str,
+        stars_count: int,
+        chat_id: int,
+        order_id: Optional[str] = None,
+        buyer_id: Optional[int] = None,
+    ) -> None:
+        self.cardinal = cardinal
+        self.username = username
+        self.stars_count = stars_count
+        self.chat_id = chat_id
+        self.order_id = order_id
+        self.buyer_id = buyer_id
+        self.recipient_key = username.strip().lstrip("@").lower()
+        self.enqueued_at = time.monotonic()
+        self.started_at: Optional[float] = None
+        self.future: concurrent.futures.Future = concurrent.futures.Future()
+
+
+class DeliveryScheduler:
+    """Пул воркеров доставки.
+
+    Заказы разным получателям выполняются параллельно, заказы одному
+    получателю — строго в порядке поступления.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[DeliveryJob], Awaitable[bool]],
+        workers: int = 3,
+        history: int = 200,
+    ) -> None:
+        self.handler = handler
+        self.workers = max(1, int(workers))
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.wait_times: Deque[float] = deque(maxlen=history)
+        self._pending: Dict[str, Deque[DeliveryJob]] = {}
+        self._ready: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        if self.loop is loop:
+            return
+        self.loop = loop
+        loop.call_soon_threadsafe(self._start_workers)
+
+    def _start_workers(self) -> None:
+        self._ready = asyncio.Queue()
+        self._tasks = [
+            self.loop.create_task(self._worker(), name=f"StarsGifterWorker-{i}")
+            for i in range(self.workers)
+        ]
+
+    def submit(self, job: DeliveryJob) -> concurrent.futures.Future:
+        """Добавить заказ в очередь (из любого потока)"""
+        if self.loop is None or self.loop.is_closed():
+            raise RuntimeError("Планировщик доставки не запущен")
+        self.loop.call_soon_threadsafe(self._enqueue, job)
+        return job.future
+
+    def _enqueue(self, job: DeliveryJob) -> None:
+        self.queued += 1
+        queue = self._pending.get(job.recipient_key)
+        if queue is not None:
+            # Получатель уже в работе или в очереди — встаём за ним
+            queue.append(job)
+            return
+        self._pending[job.recipient_key] = deque([job])
+        self._ready.put_nowait(job.recipient_key)
+
+    async def _worker(self) -> None:
+        while True:
+            key = await self._ready.get()
+            queue = self._pending[key]
+            job = queue.popleft()
+            self.queued -= 1
+            self.active += 1
+            job.started_at = time.monotonic()
+            self.wait_times.append(job.started_at - job.enqueued_at)
+            try:
+                result = await self.handler(job)
+                if not job.future.done():
+                    job.future.set_result(result)
+            except asyncio.CancelledError:
+                job.future.cancel()
+                raise
+            except Exception as e:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            finally:
+                self.active -= 1
+                self.completed += 1
+                if queue:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._pending[key]
+
+    def stats(self) -> Dict[str, Any]:
+        waits = list(self.wait_times)
+        return {
+            "workers": self.workers,
+            "queued": self.queued,
+            "active": self.active,
+            "completed": self.completed,
+            "avg_wait": sum(waits) / len(waits) if waits else 0.0,
+            "max_wait": max(waits) if waits else 0.0,
+        }
+
+
+class StarsGifterPlugin:
+    def __init__(self) -> None:
+        # Без файлового ввода-вывода: конфиг читается в init_plugin (load_config)
+        self.config_file = ConfigFile(CONFIG_FILE, DEFAULT_CONFIG)
+        self.config: Dict = {}
+        self.random_gifts: Dict[int, List[int]] = {}
+        self.configured_gifts: Dict[int, List[int]] = {}
+        self.gift_planner: Optional[GiftPlanner] = None
+        self.catalog = GiftCatalog(GIFTS_CACHE_FILE)
+        self._catalog_task: Optional[asyncio.Task] = None
+        self.lot_stars_mapping = LotIndex()
+        self.running = True
+        self.stopping = False
+        self.drain_deadline: Optional[float] = None
+        self.drain_event: Optional[asyncio.Event] = None
+        self._shutdown_lock = threading.RLock()
+        self._stopped = False
+        self._previous_sigterm: Any = None
+        self._sigterm_installed = False
+        self._sigterm_thread: Optional[threading.Thread] = None
+        self._shutdown_done = threading.Event()
+        self.loop_thread = AsyncLoopThread()
+        self.cardinal: Optional["Cardinal"] = None
+        self.metrics = Metrics()
+        self.senders_ready: Optional[asyncio.Event] = None
+        self.connect_future: Optional[concurrent.futures.Future] = None
+        self._balance_task: Optional[asyncio.Task] = None
+        self.funpay_states: Dict[Tuple[int, int], Dict] = {}
+        self.state_expiry = StateExpiry()
+        self._states_lock = threading.Lock()
+        self._sweeper_stop = threading.Event()
+        self._sweeper: Optional[threading.Thread] = None
+        self.order_futures: Dict[str, concurrent.futures.Future] = {}
+        self._orders_lock = threading.Lock()
+        self.log_listener: Optional[logging.handlers.QueueListener] = None
+        self.panel_routes: Dict[str, Callable[[Any, str], Optional[str]]] = {}
+        self.build_components()
+
+    def build_components(self) -> None:
+        """Компоненты, зависящие от настроек; пересоздаются после загрузки конфига"""
+        self.senders = self.build_senders()
+        self.scheduler = DeliveryScheduler(
+            self._run_delivery_job, workers=self.get_setting("delivery", "workers")
+        )
+        self.outbound = OutboundMessageQueue(
+            coalesce_window=self.get_setting("outbound", "coalesce_window"),
+            max_length=self.get_setting("outbound", "max_length"),
+            retries=self.get_setting("outbound", "retries"),
+            retry_backoff=self.get_setting("outbound", "retry_backoff"),
+        )
+        self.exporter = MetricsExporter(
+            self.metrics,
+            http_host=self.get_setting("metrics", "http_host"),
+            http_port=self.get_setting("metrics", "http_port"),
+            file=self.get_setting("metrics", "file"),
+            file_interval=self.get_setting("metrics", "file_interval"),
+        )
+        self.store = OrderStore(
+            STATE_DB_FILE,
+            batch_size=self.get_setting("storage", "batch_size"),
+            flush_interval=self.get_setting("storage", "flush_interval"),
+        )
+
+    def load_config(self) -> None:
+        self.catalog.load()
+        self.apply_config(self.config_file.load())
+        self.build_components()
+
+    def apply_config(self, cfg: Dict) -> None:
+        """Применяет конфиг (при запуске и после правки файла на диске)"""
+        lot_stars_mapping = LotIndex(
+            {str(k): int(v) for k, v in cfg.pop("lot_stars_mapping", {}).items()}
+        )
+        random_gifts = {
+            int(k): v for k, v in cfg.get("random_gifts", DEFAULT_CONFIG["random_gifts"]).items()
+        }
+        self.config = cfg
+        self.catalog.ttl = self.get_setting("catalog", "ttl")
+        self.catalog.include_limited = self.get_setting("catalog", "include_limited")
+        self.lot_stars_mapping = lot_stars_mapping
+        self.configured_gifts = random_gifts
+        self.update_gifts()
+        self.running = cfg.get("plugin_enabled", True)
+
+    def update_gifts(self) -> None:
+        """Действующие подарки: каталог Telegram, а без него — random_gifts из конфига"""
+        gifts = self.configured_gifts
+        if self.get_setting("catalog", "enabled") and self.catalog.gifts:
+            gifts = self.catalog.merge(self.configured_gifts) or gifts
+        self.set_gifts(gifts)
+
+    def set_gifts(self, gifts: Dict[int, List[int]]) -> None:
+        if self.gift_planner is not None and gifts == self.random_gifts:
+            return
+        self.random_gifts = gifts
+        self.gift_planner = self.build_gift_planner()
+        broken = [
+            lot_id
+            for lot_id, stars in self.lot_stars_mapping.items()
+            if self.gift_planner.plan(stars) is None
+        ]
+        if broken:
+            logger.warning(
+                "%s ⚠️ Лоты не собрать из доступных подарков: %s",
+                LOGGER_PREFIX, ", ".join(broken[:20]),
+            )
+
+    def drop_gift(self, gift_id: int) -> None:
+        """Исключить подарок, который Telegram больше не принимает"""
+        if gift_id in self.catalog.gifts and self.get_setting("catalog", "enabled"):
+            self.catalog.discard(gift_id)
+            self.update_gifts()
+            try:
+                self.catalog.save()
+            except OSError as e:
+                logger.error("%s ❌ Каталог подарков не сохранён: %s", LOGGER_PREFIX, e)
+        else:
+            gifts = {}
+            for price, ids in self.random_gifts.items():
+                ids = [i for i in ids if i != gift_id]
+                if ids:
+                    gifts[price] = ids
+            self.set_gifts(gifts)
+        logger.warning("%s ⚠️ Подарок %s недоступен и исключён", LOGGER_PREFIX, gift_id)
 
     def persist_config(self) -> None:
-        self.save_config(self.config)
+        self.config_file.save(dict(self.config, lot_stars_mapping=self.lot_stars_mapping.to_dict()))
+
+    def get_setting(self, section: str, key: str) -> Any:
+        return self.config.get(section, {}).get(key, DEFAULT_CONFIG[section][key])
+
+    def register_gauges(self) -> None:
+        self.metrics.gauge("starsgifter_queue_depth", lambda: self.scheduler.queued)
+        self.metrics.gauge("starsgifter_active_deliveries", lambda: self.scheduler.active)
+        self.metrics.gauge("starsgifter_outbound_pending", lambda: self.outbound.pending)
+        self.metrics.gauge("starsgifter_conversations", lambda: len(self.funpay_states))
+        self.metrics.gauge(
+            "starsgifter_gift_ids", lambda: sum(len(ids) for ids in self.random_gifts.values())
+        )
+        self.metrics.gauge(
+            "starsgifter_send_rate",
+            lambda: [({"account": a.name}, a.rate_limiter.rate) for a in self.senders.accounts],
+        )
+        self.metrics.gauge(
+            "starsgifter_stars_balance",
+            lambda: [
+                ({"account": a.name}, a.balance.balance)
+                for a in self.senders.accounts
+                if a.balance.balance is not None
+            ],
+        )
+        self.metrics.gauge(
+            "starsgifter_stars_reserved",
+            lambda: [({"account": a.name}, a.balance.reserved) for a in self.senders.accounts],
+        )
+
+    def send_funpay(self, cardinal: "Cardinal", chat_id: int, text: str) -> None:
+        """Отправить сообщение покупателю через фоновую очередь"""
+        self.outbound.send(cardinal, chat_id, text)
+
+    def set_state(self, key: Tuple[int, int], state: Dict) -> None:
+        with self._states_lock:
+            self.funpay_states[key] = state
+            self.schedule_state_expiry(key, time.time())
+        self.store.save_state(key, state)
+
+    def clear_state(self, key: Tuple[int, int]) -> None:
+        with self._states_lock:
+            state = self.funpay_states.pop(key, None)
+            self.state_expiry.discard(key)
+        if state is not None:
+            self.store.delete_state(key)
+
+    def schedule_state_expiry(self, key: Tuple[int, int], updated_at: float) -> None:
+        ttl = self.get_setting("states", "ttl")
+        remind_before = self.get_setting("states", "remind_before")
+        if ttl <= 0:
+            return
+        if 0 < remind_before < ttl:
+            self.state_expiry.schedule(key, updated_at + ttl - remind_before, "remind")
+        else:
+            self.state_expiry.schedule(key, updated_at + ttl, "expire")
+
+    def restore_states(self) -> None:
+        try:
+            states = self.store.load_states()
+        except sqlite3.Error as e:
+            logger.error("%s ❌ Ошибка загрузки состояний: %s", LOGGER_PREFIX, e)
+            return
+        with self._states_lock:
+            for key, state in states.items():
+                updated_at = state.pop("updated_at", None) or time.time()
+                self.funpay_states[key] = state
+                self.schedule_state_expiry(key, updated_at)
+        if self.funpay_states:
+            logger.info("%s 📂 Восстановлено диалогов: %s", LOGGER_PREFIX, len(self.funpay_states))
+
+    def sweep_states(self, now: Optional[float] = None) -> int:
+        """Напоминания и удаление брошенных диалогов, чьи сроки наступили"""
+        now = time.time() if now is None else now
+        remind_before = self.get_setting("states", "remind_before")
+        actions = []
+        with self._states_lock:
+            for key, action in self.state_expiry.pop_due(now):
+                state = self.funpay_states.get(key)
+                if state is None:
+                    continue
+                if action == "remind":
+                    self.state_expiry.schedule(key, now + remind_before, "expire")
+                else:
+                    del self.funpay_states[key]
+                actions.append((key, action, state))
+
+        for key, action, state in actions:
+            data = state["data"]
+            chat_id = data.get("chat_id", key[0])
+            order_id = data.get("order_id")
+            if action == "remind":
+                self.metrics.inc("starsgifter_state_reminders_total")
+                if state["state"] == "confirming_username":
+                    hint = "Отправьте «+» для подтверждения или новый username"
+                else:
+                    hint = "Отправьте ваш username Telegram"
+                self.send_funpay(
+                    self.cardinal,
+                    chat_id,
+                    f"⏰ Заказ #{order_id} ждёт ответа. {hint}\n"
+                    f"Без ответа ожидание закончится через {max(1, round(remind_before / 60))} мин",
+                )
+                continue
+
+            self.store.delete_state(key)
+            self.metrics.inc("starsgifter_states_expired_total")
+            order = self.store.get_order(order_id) if order_id else None
+            if order and order["status"] == ORDER_WAITING:
+                self.store.set_order_status(order_id, ORDER_EXPIRED)
+            self.send_funpay(
+                self.cardinal,
+                chat_id,
+                f"⌛ Заказ #{order_id}: время ожидания истекло. Напишите продавцу",
+            )
+            logger.warning(
+                "%s ⌛ Заказ #%s: диалог брошен (%s), удалён",
+                LOGGER_PREFIX, order_id, state["state"],
+            )
+        return len(actions)
+
+    def start_sweeper(self) -> None:
+        if self._sweeper is not None and self._sweeper.is_alive():
+            return
+        self._sweeper_stop.clear()
+        self._sweeper = threading.Thread(
+            target=self._sweep_loop, name="StarsGifterSweeper", daemon=True
+        )
+        self._sweeper.start()
+
+    def _sweep_loop(self) -> None:
+        while not self._sweeper_stop.wait(self.get_setting("states", "sweep_interval")):
+            try:
+                self.sweep_states()
+            except Exception as e:
+                logger.error("%s ❌ Ошибка очистки диалогов: %s", LOGGER_PREFIX, e)
+
+    def build_gift_planner(self) -> GiftPlanner:
+        denominations = [price for price, ids in self.random_gifts.items() if ids]
+        return GiftPlanner(denominations, self.get_setting("planner", "max_amount"))
+
+    def build_senders(self) -> SenderPool:
+        pool = SenderPool()
+        accounts = [self.config.get("pyrogram", DEFAULT_CONFIG["pyrogram"])]
+        accounts += self.config.get("pyrogram_accounts", [])
+        for settings in accounts:
+            pool.add(
+                SenderAccount(
+                    settings.get("session_name", DEFAULT_CONFIG["pyrogram"]["session_name"]),
+                    settings,
+                    AdaptiveRateLimiter(
+                        rate=self.get_setting("rate_limit", "rate"),
+                        burst=self.get_setting("rate_limit", "burst"),
+                        min_rate=self.get_setting("rate_limit", "min_rate"),
+                        max_rate=self.get_setting("rate_limit", "max_rate"),
+                    ),
+                    RecipientCache(
+                        max_size=self.get_setting("recipient_cache", "max_size"),
+                        ttl=self.get_setting("recipient_cache", "ttl"),
+                    ),
+                )
+            )
+        return pool
+
+    @property
+    def pyrogram_client(self) -> Optional["Client"]:
+        """Клиент основного аккаунта (блок pyrogram в конфиге)"""
+        return self.senders.primary.client
+
+    @pyrogram_client.setter
+    def pyrogram_client(self, client: Optional["Client"]) -> None:
+        self.senders.primary.client = client
 
-    def get_pyrogram_client(self) -> "Client":
+    def get_pyrogram_client(self, pyrogram_config: Optional[Dict] = None) -> "Client":
         if importlib.util.find_spec("pyrogram") is None:
             raise RuntimeError("pyrogram не установлен. Установите модуль pyrogram.")
 
-        from pyrogram import Client
+        from pyrogram import Client
+
+        if pyrogram_config is None:
+            pyrogram_config = self.config.get("pyrogram", DEFAULT_CONFIG["pyrogram"])
+        return Client(
+            pyrogram_config["session_name"],
+            api_id=pyrogram_config["api_id"],
+            api_hash=pyrogram_config["api_hash"],
+            phone_number=pyrogram_config.get("phone_number", ""),
+        )
+
+    def init_pyrogram(self) -> bool:
+        """Подключает аккаунты в фоне, не задерживая запуск Cardinal"""
+        accounts = []
+        for account in self.senders.accounts:
+            if not account.is_configured:
+                logger.warning(
+                    "%s API ID или API HASH не установлены (%s)",
+                    LOGGER_PREFIX, account.name,
+                )
+                continue
+            account.connecting = True
+            accounts.append(account)
+        if not accounts:
+            return False
+
+        self.loop_thread.start()
+        self.senders_ready = asyncio.Event()
+        self.connect_future = self.loop_thread.submit(self._connect_senders(accounts))
+        return True
+
+    @property
+    def is_connecting(self) -> bool:
+        return self.senders_ready is not None and not self.senders_ready.is_set()
+
+    async def _connect_senders(self, accounts: List[SenderAccount]) -> int:
+        results = await asyncio.gather(*(self._connect_account(a) for a in accounts))
+        self.senders_ready.set()
+        return sum(results)
+
+    async def _connect_account(self, account: SenderAccount) -> bool:
+        retries = self.get_setting("startup", "connect_retries")
+        backoff = self.get_setting("startup", "connect_backoff")
+        try:
+            for attempt in range(retries + 1):
+                try:
+                    account.client = await self._start_pyrogram(account.settings)
+                except Exception as e:
+                    logger.error(
+                        "%s ❌ Ошибка Pyrogram (%s, попытка %s/%s): %s",
+                        LOGGER_PREFIX, account.name, attempt + 1, retries + 1, e,
+                    )
+                    if attempt < retries:
+                        await asyncio.sleep(min(300, backoff * 2**attempt))
+                    continue
+                logger.info("%s ✅ Pyrogram запущен (%s)", LOGGER_PREFIX, account.name)
+                self.senders_ready.set()
+                if self._balance_task is None and self.get_setting("balance", "enabled"):
+                    self._balance_task = asyncio.create_task(self._balance_loop())
+                if self._catalog_task is None and self.get_setting("catalog", "enabled"):
+                    self._catalog_task = asyncio.create_task(self._catalog_loop())
+                return True
+            return False
+        finally:
+            account.connecting = False
+
+    async def wait_senders_ready(self, order_id: Optional[str] = None) -> None:
+        """Ожидание первого подключённого аккаунта, если подключение ещё идёт"""
+        if self.senders.any_connected or not self.is_connecting:
+            return
+        logger.info("%s ⏳ Заказ #%s ждёт подключения Telegram", LOGGER_PREFIX, order_id)
+        await self.until_drain(
+            self.senders_ready.wait(), self.get_setting("startup", "ready_timeout")
+        )
+
+    async def until_drain(self, awaitable: Awaitable, timeout: Optional[float] = None) -> bool:
+        """Ожидание, прерываемое остановкой плагина; False — прервано или истёк timeout"""
+        task = asyncio.ensure_future(awaitable)
+        waiters = {task}
+        if self.drain_event is not None:
+            waiters.add(asyncio.ensure_future(self.drain_event.wait()))
+        done, pending = await asyncio.wait(
+            waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+        )
+        for waiter in pending:
+            waiter.cancel()
+        if task in done:
+            task.result()
+            return True
+        return False
+
+    async def _start_pyrogram(self, pyrogram_config: Optional[Dict] = None) -> "Client":
+        # Клиент создаётся внутри loop-потока, чтобы он был привязан к этому loop
+        client = self.get_pyrogram_client(pyrogram_config)
+        await client.start()
+        return client
 
-        pyrogram_config = self.config.get("pyrogram", DEFAULT_CONFIG["pyrogram"])
-        return Client(
-            pyrogram_config["session_name"],
-            api_id=pyrogram_config["api_id"],
-            api_hash=pyrogram_config["api_hash"],
-            phone_number=pyrogram_config.get("phone_number", ""),
+    def calc_gifts_quantity(self, quantity: int) -> Optional[Dict[int, int]]:
+        """Расчёт подарков"""
+        return self.gift_planner.plan(quantity)
+
+    async def refresh_account_balance(self, account: SenderAccount) -> Optional[int]:
+        if not account.is_connected:
+            return None
+        get_stars_balance = getattr(account.client, "get_stars_balance", None)
+        if get_stars_balance is None:
+            return None
+        try:
+            balance = int(await get_stars_balance())
+        except Exception as e:
+            logger.warning(
+                "%s ⚠️ Не удалось получить баланс %s: %s",
+                LOGGER_PREFIX, account.name, e,
+            )
+            return None
+        account.balance.update(balance)
+        return balance
+
+    async def refresh_balance(self) -> Optional[int]:
+        """Обновить кэш баланса звёзд всех аккаунтов"""
+        balances = await asyncio.gather(
+            *(self.refresh_account_balance(a) for a in self.senders.accounts)
+        )
+        known = [b for b in balances if b is not None]
+        return sum(known) if known else None
+
+    async def _balance_loop(self) -> None:
+        if not any(
+            getattr(a.client, "get_stars_balance", None) is not None for a in self.senders.accounts
+        ):
+            logger.warning("%s ⚠️ Клиент не поддерживает get_stars_balance", LOGGER_PREFIX)
+            return
+        while True:
+            balance = await self.refresh_balance()
+            if balance is not None:
+                logger.debug(
+                    "%s 💰 Баланс: %s⭐, резерв: %s⭐",
+                    LOGGER_PREFIX, balance, self.senders.reserved,
+                )
+                self.resume_waiting_orders()
+            await asyncio.sleep(self.get_setting("balance", "refresh_interval"))
+
+    async def refresh_catalog(self) -> Optional[int]:
+        """Загрузить каталог подарков Telegram; None — не удалось"""
+        account = self.senders.best()
+        if account is None:
+            return None
+        try:
+            count = await self.catalog.refresh(account.client)
+            self.catalog.save()
+        except Exception as e:
+            logger.warning("%s ⚠️ Каталог подарков не обновлён: %s", LOGGER_PREFIX, e)
+            return None
+        self.update_gifts()
+        logger.info(
+            "%s 🎁 Каталог подарков: %s, номиналы: %s",
+            LOGGER_PREFIX, count, ", ".join(str(p) for p in sorted(self.random_gifts)),
         )
+        return count
+
+    async def _catalog_loop(self) -> None:
+        if not any(
+            getattr(a.client, "get_available_gifts", None) is not None
+            for a in self.senders.accounts
+        ):
+            logger.warning("%s ⚠️ Клиент не поддерживает get_available_gifts", LOGGER_PREFIX)
+            return
+        while True:
+            if not self.catalog.is_fresh:
+                await self.refresh_catalog()
+            await asyncio.sleep(max(60.0, self.catalog.expires_in))
+
+    def remaining_stars(self, order: Dict) -> int:
+        """Сколько звёзд ещё нужно отправить по заказу"""
+        gifts = self.store.get_gifts(order["order_id"])
+        if not gifts:
+            return order["stars_count"]
+        return sum(g["price"] for g in gifts if g["status"] != GIFT_SENT)
+
+    def resume_waiting_orders(self) -> None:
+        """Запустить заказы, ожидавшие пополнения баланса"""
+        if self.cardinal is None:
+            return
+        for order in self.store.list_orders([ORDER_NO_BALANCE]):
+            text = self.resume_order(self.cardinal, order["order_id"])
+            if not self.senders.is_reserved(order["order_id"]):
+                break
+            logger.info("%s %s", LOGGER_PREFIX, text)
+
+    async def resolve_recipient(
+        self, username: str, account: Optional[SenderAccount] = None
+    ) -> Optional[Any]:
+        """Пользователь Telegram по username с кэшированием"""
+        account = account or self.senders.best()
+        if account is None:
+            raise RuntimeError("Клиент Telegram не подключен")
+        return await account.resolve(username)
+
+    def prefetch_recipient(
+        self, username: str, on_missing: Optional[Callable[[], None]] = None
+    ) -> None:
+        """Заранее разрешить username, пока покупатель подтверждает данные.
+
+        Если Telegram ответил, что пользователя нет, и включён recipient_cache.verify,
+        вызывается on_missing — покупатель узнаёт об ошибке до подтверждения.
+        """
+        if not self.get_setting("recipient_cache", "prefetch"):
+            return
+        if not self.senders.any_connected:
+            return
+        try:
+            future = self.loop_thread.submit(self.resolve_recipient(username))
+        except RuntimeError:
+            return
+        verify = on_missing is not None and self.get_setting("recipient_cache", "verify")
 
-    def init_pyrogram(self) -> bool:
-        pyrogram_config = self.config.get("pyrogram", DEFAULT_CONFIG["pyrogram"])
+        def done(f: concurrent.futures.Future) -> None:
+            error = f.exception()
+            if error is None:
+                missing = f.result() is None
+            else:
+                logger.debug("%s Предзагрузка %s: %s", LOGGER_PREFIX, username, error)
+                missing = is_username_missing(error)
+            if missing and verify:
+                on_missing()
 
-        if not pyrogram_config.get("api_id") or not pyrogram_config.get("api_hash"):
-            logger.warning(f"{LOGGER_PREFIX} API ID или API HASH не установлены")
-            return False
+        future.add_done_callback(done)
 
-        try:
-            self.pyrogram_client = self.get_pyrogram_client()
-            self.pyrogram_client.start()
-            logger.info(f"{LOGGER_PREFIX} ✅ Pyrogram запущен")
+    def reject_username(
+        self, cardinal: "Cardinal", state_key: Tuple[int, int], username: str
+    ) -> None:
+        """Вернуть диалог к вводу username, если покупатель ещё не подтвердил этот"""
+        state = self.funpay_states.get(state_key)
+        if not state or state["state"] != "confirming_username":
+            return
+        if state["data"].get("username") != username:
+            return
+        data = state["data"]
+        self.set_state(
+            state_key,
+            {
+                "state": "waiting_for_username",
+                "data": {
+                    "order_id": data["order_id"],
+                    "stars_count": data["stars_count"],
+                    "chat_id": data["chat_id"],
+                },
+            },
+        )
+        self.metrics.inc("starsgifter_usernames_rejected_total", reason="not_found")
+        if username.startswith("@"):
+            text = f"❌ Пользователь {username} не найден в Telegram. Отправьте другой username"
+        else:
+            # Без общего чата Telegram не отдаёт пользователя по одному ID
+            text = f"❌ Пользователь с ID {username} недоступен. Отправьте @username"
+        self.send_funpay(cardinal, data["chat_id"], text)
+
+    async def send_gift_limited(self, account: SenderAccount, recipient: Any, gift_id: int) -> None:
+        """send_gift через лимитер аккаунта; на FloodWait — пауза и повтор.
+
+        Если есть другой доступный аккаунт, FloodWait пробрасывается сразу,
+        чтобы подарок ушёл с него, а не ждал.
+        """
+        limiter = account.rate_limiter
+        max_retries = self.get_setting("rate_limit", "max_flood_retries")
+        max_wait = self.get_setting("rate_limit", "max_flood_wait")
+        retries = 0
+        while True:
+            if not await self.until_drain(limiter.acquire()):
+                raise DeliveryInterrupted()
+            try:
+                await account.client.send_gift(chat_id=recipient, gift_id=gift_id)
+            except Exception as e:
+                wait = get_flood_wait(e)
+                if wait is None:
+                    raise
+                limiter.on_flood_wait(wait)
+                self.metrics.inc("starsgifter_flood_waits_total", account=account.name)
+                if retries >= max_retries or wait > max_wait or self.senders.has_alternative(account):
+                    raise
+                retries += 1
+                logger.warning(
+                    "%s ⏸ FloodWait %s с (%s), повтор %s/%s | скорость %.2f/с",
+                    LOGGER_PREFIX, wait, account.name, retries, max_retries, limiter.rate,
+                )
+                continue
+            limiter.on_success()
+            return
+
+    async def deliver_gift(
+        self, username: str, price: int, order_id: Optional[str], index: int, remaining: int
+    ) -> bool:
+        """Отправить один подарок заказа с повторами, переключением аккаунтов и записью в журнал"""
+        retries = self.get_setting("delivery", "gift_retries")
+        backoff = self.get_setting("delivery", "retry_backoff")
+        threshold = self.get_setting("senders", "error_threshold")
+        cooldown = self.get_setting("senders", "error_cooldown")
+        for attempt in range(retries + 1):
+            account = self.senders.account_for(order_id, remaining)
+            gift_id = None
+            try:
+                if account is None:
+                    raise RuntimeError("Клиент Telegram не подключен")
+                user = await account.resolve(username)
+                if not user:
+                    raise RuntimeError(f"Пользователь {username} не найден")
+                ids = self.random_gifts.get(price)
+                if not ids:
+                    raise RuntimeError(f"Нет доступных подарков по {price}⭐")
+                gift_id = random.choice(ids)
+                started = time.monotonic()
+                await self.send_gift_limited(account, user.id, gift_id)
+                self.metrics.observe(
+                    "starsgifter_gift_seconds", time.monotonic() - started, account=account.name
+                )
+            except DeliveryInterrupted:
+                raise
+            except Exception as e:
+                self.metrics.inc(
+                    "starsgifter_gifts_failed_total",
+                    account=account.name if account is not None else "",
+                )
+                logger.error(
+                    "%s Ошибка отправки подарка %s (попытка %s/%s): %s",
+                    LOGGER_PREFIX, price, attempt + 1, retries + 1, e,
+                )
+                if order_id:
+                    self.store.mark_gift(order_id, index, GIFT_FAILED, gift_id, str(e))
+                if gift_id is not None and is_gift_unavailable(e):
+                    self.drop_gift(gift_id)
+                if account is not None and is_recipient_error(e):
+                    # Следующая попытка и /stars_resume резолвят получателя заново
+                    account.recipients.invalidate(username)
+                if account is not None:
+                    account.record_error(get_flood_wait(e), threshold, cooldown)
+                    if self.senders.has_alternative(account):
+                        continue
+                if attempt < retries:
+                    if not await self.until_drain(asyncio.sleep(backoff * 2**attempt)):
+                        raise DeliveryInterrupted()
+                continue
+            if order_id:
+                self.store.mark_gift(order_id, index, GIFT_SENT, gift_id, sync=True)
+            account.record_success()
+            account.balance.consume(order_id, price)
+            self.metrics.inc("starsgifter_gifts_sent_total", account=account.name)
             return True
-        except Exception as e:
-            logger.error(f"{LOGGER_PREFIX} ❌ Ошибка Pyrogram: {e}")
-            return False
+        return False
 
     @staticmethod
-    async def calc_gifts_quantity(quantity: int) -> Optional[Dict[int, int]]:
-        """Расчёт подарков"""
-        for d in range(quantity // 100, -1, -1):
-            remain_after_100 = quantity - d * 100
-            for c in range(remain_after_100 // 50, -1, -1):
-                remain_after_50 = remain_after_100 - c * 50
-                for b in range(remain_after_50 // 25, -1, -1):
-                    remain_after_25 = remain_after_50 - b * 25
-                    if remain_after_25 % 15 == 0:
-                        a = remain_after_25 // 15
-                        return {100: d, 50: c, 25: b, 15: a}
-        return None
+    def expand_gifts(gifts_dict: Dict[int, int]) -> List[Tuple[int, int]]:
+        """Пронумерованный список подарков [(индекс, номинал)] по убыванию номинала"""
+        prices = [
+            price for price, count in sorted(gifts_dict.items(), reverse=True) for _ in range(count)
+        ]
+        return list(enumerate(prices))
 
     @staticmethod
     def format_gifts_result(gifts_dict: Dict[int, int]) -> str:
@@ -136,9 +2707,9 @@ class StarsGifterPlugin:
         result = []
         for price, count in sorted(gifts_dict.items(), reverse=True):
             if count > 0:
-                if count == 1:
+                if count % 10 == 1 and count % 100 != 11:
                     result.append(f"{count} подарок по {price} звёзд")
-                elif 2 <= count <= 4:
+                elif 2 <= count % 10 <= 4 and not 12 <= count % 100 <= 14:
                     result.append(f"{count} подарка по {price} звёзд")
                 else:
                     result.append(f"{count} подарков по {price} звёзд")
@@ -151,49 +2722,121 @@ class StarsGifterPlugin:
         stars_count: int,
         chat_id: int,
         order_id: Optional[str] = None,
+        buyer_id: Optional[int] = None,
     ) -> bool:
         """Отправить звёзды"""
         try:
-            if self.pyrogram_client is None or not self.pyrogram_client.is_connected:
-                cardinal.account.send_message(chat_id, "❌ Клиент Telegram не подключен")
+            if not self.senders.any_connected:
+                self.send_funpay(cardinal, chat_id, "❌ Клиент Telegram не подключен")
+                self.fail_order(order_id)
                 return False
 
-            gifts_distribution = await self.calc_gifts_quantity(stars_count)
-            if not gifts_distribution:
-                cardinal.account.send_message(chat_id, "❌ Ошибка расчёта подарков")
-                return False
+            ledger = self.store.get_gifts(order_id) if order_id else []
+            if ledger:
+                ledger = self.replan_ledger(order_id, ledger)
+                # Повторная доставка: план берётся из журнала, отправленное пропускается
+                items = [(g["gift_index"], g["price"]) for g in ledger]
+                sent_indexes = {g["gift_index"] for g in ledger if g["status"] == GIFT_SENT}
+                gifts_distribution: Dict[int, int] = {}
+                for _, price in items:
+                    gifts_distribution[price] = gifts_distribution.get(price, 0) + 1
+            else:
+                gifts_distribution = self.calc_gifts_quantity(stars_count)
+                if not gifts_distribution:
+                    self.send_funpay(cardinal, chat_id, "❌ Ошибка расчёта подарков")
+                    self.fail_order(order_id)
+                    return False
+                items = self.expand_gifts(gifts_distribution)
+                sent_indexes = set()
 
             try:
-                user = await self.pyrogram_client.get_users([username])
-                if not user:
-                    cardinal.account.send_message(chat_id, f"❌ Пользователь {username} не найден")
-                    return False
+                user = await self.resolve_recipient(
+                    username, self.senders.account_for(order_id, stars_count)
+                )
             except Exception as e:
-                logger.error(f"{LOGGER_PREFIX} Ошибка поиска {username}: {e}")
-                cardinal.account.send_message(chat_id, f"❌ Ошибка: {e}")
+                if not is_username_missing(e):
+                    logger.error("%s Ошибка поиска %s: %s", LOGGER_PREFIX, username, e)
+                    self.send_funpay(cardinal, chat_id, f"❌ Ошибка: {e}")
+                    self.fail_order(order_id)
+                    return False
+                user = None
+            if not user:
+                self.ask_username_again(cardinal, username, stars_count, chat_id, order_id, buyer_id)
                 return False
 
-            success_count = 0
+            self.metrics.trace(order_id, "resolved")
+            if order_id:
+                if ledger:
+                    logger.info(
+                        "%s 🔁 Заказ #%s: уже отправлено %s/%s",
+                        LOGGER_PREFIX, order_id, len(sent_indexes), len(items),
+                    )
+                else:
+                    self.store.save_gift_plan(order_id, items)
+                self.store.save_order(order_id, chat_id, stars_count, ORDER_DELIVERING, username)
+
+            success_count = len(sent_indexes)
             failed_count = 0
+            remaining = sum(price for index, price in items if index not in sent_indexes)
+            sent_stars = sum(price for index, price in items if index in sent_indexes)
+            progress_every = self.get_setting("delivery", "progress_every")
+            if progress_every and len(items) > progress_every:
+                self.send_funpay(
+                    cardinal, chat_id, f"📦 Подарков в заказе: {len(items)}, отправляю по очереди"
+                )
 
-            for price, count in gifts_distribution.items():
-                for _ in range(count):
-                    try:
-                        gift_id = random.choice(self.random_gifts[price])
-                        await self.pyrogram_client.send_gift(chat_id=username, gift_id=gift_id)
-                        success_count += 1
-                        await asyncio.sleep(2)
-                    except Exception as e:
-                        logger.error(f"{LOGGER_PREFIX} Ошибка отправки подарка {price}: {e}")
-                        failed_count += 1
+            for index, price in items:
+                if index in sent_indexes:
+                    continue
+                try:
+                    if self.drain_expired:
+                        raise DeliveryInterrupted()
+                    delivered = await self.deliver_gift(username, price, order_id, index, remaining)
+                except DeliveryInterrupted:
+                    # Остановка: остаток дошлётся после перезапуска по журналу
+                    self.checkpoint_order(cardinal, order_id, chat_id, success_count, len(items))
+                    return False
+                if delivered:
+                    success_count += 1
+                    sent_stars += price
+                else:
+                    failed_count += 1
+                remaining -= price
+                done = success_count + failed_count
+                if progress_every and done % progress_every == 0 and done < len(items):
+                    self.send_funpay(
+                        cardinal,
+                        chat_id,
+                        f"⏳ Отправлено {success_count}/{len(items)} подарков "
+                        f"({sent_stars}/{stars_count}⭐)",
+                    )
+
+            self.metrics.trace(order_id, "delivered")
+            if failed_count:
+                await self.refresh_balance()
+
+            if order_id:
+                if failed_count == 0:
+                    status = ORDER_DELIVERED
+                else:
+                    status = ORDER_PARTIAL if success_count else ORDER_FAILED
+                self.store.set_order_status(order_id, status, sync=True)
 
             report = f"✅ Отправлено: {stars_count} stars\n\n" + self.format_gifts_result(
                 gifts_distribution
             )
             if failed_count > 0:
-                report += f"\n\n❌ Не удалось: {failed_count}"
+                # partial/failed сами не повторяются — досылает продавец через /stars_resume
+                report += (
+                    f"\n\n❌ Не удалось: {failed_count}\n"
+                    "Продавец дошлёт недостающие подарки"
+                )
+                logger.warning(
+                    "%s ⚠️ Заказ #%s: не отправлено %s подарков — /stars_resume %s",
+                    LOGGER_PREFIX, order_id, failed_count, order_id,
+                )
 
-            cardinal.account.send_message(chat_id, report)
+            self.send_funpay(cardinal, chat_id, report)
 
             if failed_count == 0:
                 review_msg = (
@@ -202,14 +2845,180 @@ class StarsGifterPlugin:
                 )
                 if order_id:
                     review_msg += f"\n✨ https://funpay.com/orders/{order_id}/"
-                cardinal.account.send_message(chat_id, review_msg)
+                self.send_funpay(cardinal, chat_id, review_msg)
 
-            return True
+            self.metrics.trace(order_id, "reported")
+            return failed_count == 0
 
         except Exception as e:
-            logger.error(f"{LOGGER_PREFIX} Ошибка отправки: {e}")
-            cardinal.account.send_message(chat_id, f"❌ Ошибка: {str(e)}")
+            logger.error("%s Ошибка отправки: %s", LOGGER_PREFIX, e)
+            self.send_funpay(cardinal, chat_id, f"❌ Ошибка: {str(e)}")
+            self.fail_order(order_id)
+            return False
+
+        finally:
+            if order_id:
+                self.senders.release(order_id)
+
+    def replan_ledger(self, order_id: str, ledger: List[Dict]) -> List[Dict]:
+        """Пересобрать неотправленный остаток, если его номиналов больше нет в каталоге"""
+        unsent = [g for g in ledger if g["status"] != GIFT_SENT]
+        if all(self.random_gifts.get(g["price"]) for g in unsent):
+            return ledger
+        rest = sum(g["price"] for g in unsent)
+        plan = self.calc_gifts_quantity(rest)
+        if plan is None:
+            logger.error(
+                "%s ❌ Заказ #%s: остаток %s⭐ нельзя собрать из текущих подарков",
+                LOGGER_PREFIX, order_id, rest,
+            )
+            return ledger
+        start = max(g["gift_index"] for g in ledger) + 1
+        items = [(start + index, price) for index, price in self.expand_gifts(plan)]
+        self.store.replace_pending_gifts(order_id, items)
+        logger.info(
+            "%s 🔄 Заказ #%s: остаток %s⭐ пересобран: %s",
+            LOGGER_PREFIX, order_id, rest, plan,
+        )
+        return self.store.get_gifts(order_id)
+
+    def fail_order(self, order_id: Optional[str]) -> None:
+        """Заказ не доставлен: статус failed, дослать можно через /stars_resume"""
+        if order_id:
+            self.store.set_order_status(order_id, ORDER_FAILED, sync=True)
+
+    def ask_username_again(
+        self,
+        cardinal: "Cardinal",
+        username: str,
+        stars_count: int,
+        chat_id: int,
+        order_id: Optional[str],
+        buyer_id: Optional[int],
+    ) -> None:
+        """Получатель не найден при доставке — вернуть покупателя к вводу username"""
+        self.metrics.inc("starsgifter_usernames_rejected_total", reason="delivery")
+        if order_id is None or buyer_id is None:
+            # Доставка не из диалога (/stars_resume): спросить покупателя некому
+            self.send_funpay(cardinal, chat_id, f"❌ Пользователь {username} не найден")
+            self.fail_order(order_id)
+            return
+        self.store.set_order_status(order_id, ORDER_WAITING, sync=True)
+        self.set_state(
+            (chat_id, buyer_id),
+            {
+                "state": "waiting_for_username",
+                "data": {"order_id": order_id, "chat_id": chat_id, "stars_count": stars_count},
+            },
+        )
+        self.send_funpay(
+            cardinal,
+            chat_id,
+            f"❌ Пользователь {username} не найден в Telegram. Отправьте другой username",
+        )
+
+    def submit_stars_gifts(
+        self,
+        cardinal: "Cardinal",
+        username: str,
+        stars_count: int,
+        chat_id: int,
+        order_id: Optional[str] = None,
+        buyer_id: Optional[int] = None,
+    ) -> concurrent.futures.Future:
+        """Поставить отправку звёзд в очередь доставки (потокобезопасно)"""
+        self.loop_thread.start()
+        self.scheduler.start(self.loop_thread.loop)
+        with self._orders_lock:
+            existing = self.order_futures.get(order_id) if order_id else None
+            if existing is not None and not existing.done():
+                # Заказ уже в очереди или доставляется — второй раз не ставим
+                return existing
+            job = DeliveryJob(cardinal, username, stars_count, chat_id, order_id, buyer_id)
+            future = self.scheduler.submit(job)
+            if order_id:
+                self.order_futures[order_id] = future
+        future.add_done_callback(lambda f: self._on_delivery_done(order_id, f))
+        stats = self.scheduler.stats()
+        logger.info(
+            "%s 📥 Заказ #%s в очереди | ожидают: %s, в работе: %s",
+            LOGGER_PREFIX, order_id, stats["queued"] + 1, stats["active"],
+        )
+        return future
+
+    async def _run_delivery_job(self, job: DeliveryJob) -> bool:
+        wait = job.started_at - job.enqueued_at
+        self.metrics.trace(job.order_id, "queued")
+        if wait >= 1:
+            logger.info("%s ⏳ Заказ #%s ждал в очереди %.1f с", LOGGER_PREFIX, job.order_id, wait)
+        if self.drain_expired:
+            self.checkpoint_order(job.cardinal, job.order_id, job.chat_id)
+            return False
+        await self.wait_senders_ready(job.order_id)
+        if self.drain_expired:
+            self.checkpoint_order(job.cardinal, job.order_id, job.chat_id)
             return False
+        return await self.send_stars_gifts(
+            job.cardinal, job.username, job.stars_count, job.chat_id, job.order_id, job.buyer_id
+        )
+
+    def _on_delivery_done(self, order_id: Optional[str], future: concurrent.futures.Future) -> None:
+        with self._orders_lock:
+            if self.order_futures.get(order_id) is future:
+                del self.order_futures[order_id]
+        try:
+            if future.result():
+                self.metrics.finish(order_id, ORDER_DELIVERED)
+                logger.info("%s ✅ Заказ #%s завершён!", LOGGER_PREFIX, order_id)
+            elif self.stopping and self.is_order_paused(order_id):
+                self.metrics.finish(order_id, ORDER_PAUSED)
+            else:
+                self.metrics.finish(order_id, ORDER_FAILED)
+                logger.warning("%s ⚠️ Заказ #%s не выполнен", LOGGER_PREFIX, order_id)
+        except Exception as e:
+            self.metrics.finish(order_id, "error")
+            logger.error("%s ❌ Заказ #%s: %s", LOGGER_PREFIX, order_id, e)
+
+    @property
+    def drain_expired(self) -> bool:
+        """Остановка идёт дольше drain_timeout — новые подарки не начинаем"""
+        return self.drain_deadline is not None and time.monotonic() >= self.drain_deadline
+
+    def is_order_paused(self, order_id: Optional[str]) -> bool:
+        order = self.store.get_order(order_id) if order_id else None
+        return order is not None and order["status"] == ORDER_PAUSED
+
+    def checkpoint_order(
+        self,
+        cardinal: "Cardinal",
+        order_id: Optional[str],
+        chat_id: int,
+        sent: int = 0,
+        total: int = 0,
+    ) -> None:
+        """Отложить заказ до перезапуска: журнал подарков уже записан"""
+        if order_id:
+            self.store.set_order_status(order_id, ORDER_PAUSED, sync=True)
+        if total:
+            text = (
+                f"⏸ Бот перезапускается. Отправлено {sent}/{total} подарков, "
+                "остальные придут сразу после перезапуска"
+            )
+        else:
+            text = "⏸ Бот перезапускается. Звёзды будут отправлены сразу после перезапуска"
+        self.send_funpay(cardinal, chat_id, text)
+        logger.warning(
+            "%s ⏸ Заказ #%s отложен до перезапуска (%s/%s)",
+            LOGGER_PREFIX, order_id, sent, total,
+        )
+
+    def resume_paused_orders(self) -> None:
+        """Продолжить заказы, отложенные при прошлой остановке"""
+        if not self.senders.has_usable:
+            return
+        for order in self.store.list_orders([ORDER_PAUSED], limit=1000):
+            text = self.resume_order(self.cardinal, order["order_id"])
+            logger.info("%s %s", LOGGER_PREFIX, text)
 
     def handle_new_order(self, cardinal: "Cardinal", event: NewOrderEvent, *args) -> None:
         """Обработка нового заказа - ОСНОВНАЯ ФУНКЦИЯ"""
@@ -223,48 +3032,83 @@ class StarsGifterPlugin:
             buyer_id = order.buyer_id
             lot_id = str(order.lot_id) if hasattr(order, "lot_id") else None
 
-            logger.info(f"{LOGGER_PREFIX} 📦 Новый заказ #{order_id} | Лот: {lot_id}")
+            logger.info("%s 📦 Новый заказ #%s | Лот: %s", LOGGER_PREFIX, order_id, lot_id)
 
             if not lot_id or lot_id not in self.lot_stars_mapping:
-                logger.warning(f"{LOGGER_PREFIX} ⚠️ Лот {lot_id} не в маппинге")
+                logger.warning("%s ⚠️ Лот %s не в маппинге", LOGGER_PREFIX, lot_id)
+                return
+
+            known = self.store.get_order(order_id)
+            if known and known["status"] != ORDER_WAITING:
+                logger.warning(
+                    "%s ⚠️ Заказ #%s уже известен (%s)",
+                    LOGGER_PREFIX, order_id, known["status"],
+                )
                 return
 
             stars_per_lot = self.lot_stars_mapping[lot_id]
-            amount = order.amount if hasattr(order, "amount") else 1
+            amount = int(getattr(order, "amount", 1) or 1)
             total_stars = stars_per_lot * amount
+            max_lots = self.get_setting("delivery", "max_lots")
 
-            if amount != 1:
-                cardinal.account.send_message(
+            if amount < 1 or amount > max_lots:
+                self.send_funpay(
+                    cardinal,
                     chat_id,
-                    f"❌ Заказали {amount} лотов ({total_stars} Stars). По одному!",
+                    f"❌ Заказали {amount} лотов ({total_stars} Stars). "
+                    f"За раз можно не больше {max_lots}",
                 )
                 logger.warning(
-                    f"{LOGGER_PREFIX} ⚠️ Заказ #{order_id} - неверное кол-во ({amount})"
+                    "%s ⚠️ Заказ #%s - неверное кол-во (%s)",
+                    LOGGER_PREFIX, order_id, amount,
+                )
+                return
+
+            if self.calc_gifts_quantity(total_stars) is None:
+                self.send_funpay(
+                    cardinal,
+                    chat_id,
+                    f"❌ Сейчас не получается собрать {total_stars} Stars из подарков. "
+                    "Напишите продавцу",
+                )
+                logger.error(
+                    "%s ❌ Заказ #%s: %s⭐ нельзя собрать из подарков %s",
+                    LOGGER_PREFIX, order_id, total_stars, sorted(self.random_gifts),
                 )
                 return
 
+            if amount > 1:
+                title = f"{amount} × {stars_per_lot} = {total_stars} Stars"
+            else:
+                title = f"{total_stars} Stars"
             welcome_msg = (
-                f"✨ Спасибо за заказ {total_stars} Stars!\n\n"
+                f"✨ Спасибо за заказ {title}!\n\n"
                 "Отправьте ваш username Telegram:\n"
                 "• @username\n• username\n• ID пользователя"
             )
 
-            cardinal.account.send_message(chat_id, welcome_msg)
+            self.send_funpay(cardinal, chat_id, welcome_msg)
 
             state_key = (chat_id, buyer_id)
-            self.funpay_states[state_key] = {
-                "state": "waiting_for_username",
-                "data": {
-                    "order_id": order_id,
-                    "chat_id": chat_id,
-                    "stars_count": total_stars,
+            self.set_state(
+                state_key,
+                {
+                    "state": "waiting_for_username",
+                    "data": {
+                        "order_id": order_id,
+                        "chat_id": chat_id,
+                        "stars_count": total_stars,
+                        "amount": amount,
+                    },
                 },
-            }
+            )
+            self.store.save_order(order_id, chat_id, total_stars, ORDER_WAITING)
 
-            logger.info(f"{LOGGER_PREFIX} ✅ Заказ #{order_id} обработан. Ожидаю username")
+            self.metrics.trace(order_id, "received")
+            logger.info("%s ✅ Заказ #%s обработан. Ожидаю username", LOGGER_PREFIX, order_id)
 
         except Exception as e:
-            logger.error(f"{LOGGER_PREFIX} ❌ Ошибка обработки заказа: {e}")
+            logger.error("%s ❌ Ошибка обработки заказа: %s", LOGGER_PREFIX, e)
 
     def handle_new_message(self, cardinal: "Cardinal", event: NewMessageEvent, *args) -> None:
         """Обработка сообщений от пользователя"""
@@ -279,91 +3123,213 @@ class StarsGifterPlugin:
             return
 
         if state["state"] == "waiting_for_username":
-            username = message.text.strip()
+            text = (message.text or "").strip()
             order_id = state["data"]["order_id"]
             stars_count = state["data"]["stars_count"]
 
-            if not username:
-                cardinal.account.send_message(message.chat_id, "❌ Отправьте username")
+            if not text:
+                self.send_funpay(cardinal, message.chat_id, "❌ Отправьте username")
                 return
 
-            cardinal.account.send_message(
+            username = normalize_username(text)
+            if username is None:
+                self.metrics.inc("starsgifter_usernames_rejected_total", reason="invalid")
+                self.send_funpay(cardinal, message.chat_id, USERNAME_HINT)
+                return
+
+            self.metrics.trace(order_id, "username")
+
+            self.send_funpay(
+                cardinal,
                 message.chat_id,
                 f"✓ Проверьте данные:\n• Username: {username}\n• Звёзды: {stars_count}\n\n"
                 "Отправьте «+» для подтверждения или новый username",
             )
 
-            self.funpay_states[state_key] = {
-                "state": "confirming_username",
-                "data": {
-                    "username": username,
-                    "order_id": order_id,
-                    "stars_count": stars_count,
-                    "chat_id": message.chat_id,
+            self.set_state(
+                state_key,
+                {
+                    "state": "confirming_username",
+                    "data": {
+                        "username": username,
+                        "order_id": order_id,
+                        "stars_count": stars_count,
+                        "chat_id": message.chat_id,
+                    },
                 },
-            }
+            )
+            self.prefetch_recipient(
+                username, lambda: self.reject_username(cardinal, state_key, username)
+            )
             return
 
         if state["state"] == "confirming_username":
             order_id = state["data"]["order_id"]
-            response = message.text.strip().lower()
+            response = (message.text or "").strip().lower()
 
             if response in CONFIRM_RESPONSES:
                 username = state["data"]["username"]
                 stars_count = state["data"]["stars_count"]
                 chat_id = state["data"]["chat_id"]
 
-                cardinal.account.send_message(chat_id, f"🚀 Отправляю {stars_count} звёзд...")
-                logger.info(f"{LOGGER_PREFIX} 📤 Отправка #{order_id} | {username} | {stars_count}★")
-
-                asyncio.run(self.send_stars_gifts(cardinal, username, stars_count, chat_id, order_id))
+                if self.stopping:
+                    # Диалог остаётся в базе, «+» сработает после перезапуска
+                    self.send_funpay(
+                        cardinal, chat_id, "⏳ Бот перезапускается. Отправьте «+» через минуту"
+                    )
+                    return
+
+                self.clear_state(state_key)
+                order = self.store.get_order(order_id)
+                if order and order["status"] in ACTIVE_ORDER_STATUSES:
+                    self.send_funpay(cardinal, chat_id, "ℹ️ Заказ уже обрабатывается")
+                    return
+
+                if not self.senders.has_usable:
+                    # Без аккаунта ждать пополнения бессмысленно: заказ — в /stars_resume
+                    self.store.save_order(order_id, chat_id, stars_count, ORDER_FAILED, username)
+                    self.send_funpay(cardinal, chat_id, "❌ Клиент Telegram не подключен")
+                    logger.error(
+                        "%s ❌ Заказ #%s: нет настроенного аккаунта Telegram",
+                        LOGGER_PREFIX, order_id,
+                    )
+                    return
+
+                if not self.senders.reserve(order_id, stars_count):
+                    self.store.save_order(order_id, chat_id, stars_count, ORDER_NO_BALANCE, username)
+                    self.send_funpay(
+                        cardinal, chat_id, "⏳ Заказ принят. Звёзды будут отправлены чуть позже"
+                    )
+                    logger.warning(
+                        "%s ⚠️ Не хватает звёзд для #%s: нужно %s, доступно %s",
+                        LOGGER_PREFIX, order_id, stars_count, self.senders.available,
+                    )
+                    return
+
+                if self.is_connecting and not self.senders.any_connected:
+                    self.send_funpay(
+                        cardinal, chat_id, "⏳ Заказ в очереди, подключаюсь к Telegram..."
+                    )
+                else:
+                    self.send_funpay(cardinal, chat_id, f"🚀 Отправляю {stars_count} звёзд...")
+                logger.info(
+                    "%s 📤 Отправка #%s | %s | %s★",
+                    LOGGER_PREFIX, order_id, username, stars_count,
+                )
+                self.metrics.trace(order_id, "confirmed")
 
-                logger.info(f"{LOGGER_PREFIX} ✅ Заказ #{order_id} завершён!")
-                self.funpay_states.pop(state_key, None)
+                self.store.save_order(order_id, chat_id, stars_count, ORDER_QUEUED, username)
+                self.submit_stars_gifts(
+                    cardinal, username, stars_count, chat_id, order_id, message.author_id
+                )
                 return
 
             if response in CANCEL_RESPONSES:
-                self.funpay_states[state_key] = {
-                    "state": "waiting_for_username",
-                    "data": {
-                        "order_id": order_id,
-                        "stars_count": state["data"]["stars_count"],
-                        "chat_id": state["data"]["chat_id"],
+                self.set_state(
+                    state_key,
+                    {
+                        "state": "waiting_for_username",
+                        "data": {
+                            "order_id": order_id,
+                            "stars_count": state["data"]["stars_count"],
+                            "chat_id": state["data"]["chat_id"],
+                        },
                     },
-                }
-                cardinal.account.send_message(message.chat_id, "🔄 Отправьте новый username")
+                )
+                self.send_funpay(cardinal, message.chat_id, "🔄 Отправьте новый username")
                 return
 
-            new_username = message.text.strip()
-            cardinal.account.send_message(
+            new_username = normalize_username(message.text or "")
+            if new_username is None:
+                self.metrics.inc("starsgifter_usernames_rejected_total", reason="invalid")
+                self.send_funpay(
+                    cardinal, message.chat_id, f"{USERNAME_HINT}\nИли «+» для подтверждения"
+                )
+                return
+            self.send_funpay(
+                cardinal,
                 message.chat_id,
                 f"✓ Проверьте:\n• Username: {new_username}\n• Звёзды: {state['data']['stars_count']}\n\n"
                 "Отправьте «+» или новый username",
             )
 
-            self.funpay_states[state_key] = {
-                "state": "confirming_username",
-                "data": {
-                    "username": new_username,
-                    "order_id": order_id,
-                    "stars_count": state["data"]["stars_count"],
-                    "chat_id": state["data"]["chat_id"],
+            self.set_state(
+                state_key,
+                {
+                    "state": "confirming_username",
+                    "data": {
+                        "username": new_username,
+                        "order_id": order_id,
+                        "stars_count": state["data"]["stars_count"],
+                        "chat_id": state["data"]["chat_id"],
+                    },
                 },
-            }
+            )
+            self.prefetch_recipient(
+                new_username, lambda: self.reject_username(cardinal, state_key, new_username)
+            )
 
-    def show_simple_panel(self, cardinal: "Cardinal", chat_id: int) -> None:
+    def resume_order(self, cardinal: "Cardinal", order_id: str) -> str:
+        """Дослать недостающие подарки прерванного заказа"""
+        if self.stopping:
+            return "⏳ Плагин останавливается"
+        order = self.store.get_order(order_id)
+        if not order:
+            return f"❌ Заказ #{order_id} не найден"
+        if order["status"] == ORDER_DELIVERED:
+            return f"ℹ️ Заказ #{order_id} уже доставлен"
+        if not order["username"]:
+            return f"❌ У заказа #{order_id} нет username"
+        future = self.order_futures.get(order_id)
+        if future is not None and not future.done():
+            return f"ℹ️ Заказ #{order_id} уже доставляется"
+
+        if not self.senders.has_usable:
+            return "❌ Клиент Telegram не подключен"
+        remaining = self.remaining_stars(order)
+        if not self.senders.reserve(order_id, remaining):
+            self.store.set_order_status(order_id, ORDER_NO_BALANCE)
+            return (
+                f"❌ Не хватает звёзд для #{order_id}: нужно {remaining}, "
+                f"доступно {self.senders.available}"
+            )
+
+        self.store.set_order_status(order_id, ORDER_QUEUED, sync=True)
+        self.submit_stars_gifts(
+            cardinal, order["username"], order["stars_count"], order["chat_id"], order_id
+        )
+        return f"🔁 Заказ #{order_id} поставлен на дозаправку"
+
+    def list_resumable_orders(self) -> str:
+        orders = self.store.list_orders(RESUMABLE_ORDER_STATUSES)
+        if not orders:
+            return "✅ Прерванных заказов нет"
+        text = "<b>🔁 Прерванные заказы:</b>\n\n"
+        for order in orders:
+            gifts = self.store.get_gifts(order["order_id"])
+            sent = sum(1 for g in gifts if g["status"] == GIFT_SENT)
+            text += (
+                f"• <code>{order['order_id']}</code> | {order['username']} | "
+                f"{order['stars_count']}⭐ | {order['status']} ({sent}/{len(gifts)})\n"
+            )
+        text += "\n<code>/stars_resume ID</code> — дослать"
+        return text
+
+    def render_panel(self) -> Tuple[str, InlineKeyboardMarkup]:
         keyboard = InlineKeyboardMarkup(row_width=2)
 
         status = "🟢 ВКЛЮЧЕН" if self.running else "🔴 ВЫКЛЮЧЕН"
         lots_count = len(self.lot_stars_mapping)
 
         keyboard.row(
-            InlineKeyboardButton(f"Статус: {status}", callback_data="show_status"),
-            InlineKeyboardButton("🔄 Вкл/Выкл", callback_data="toggle"),
+            InlineKeyboardButton(f"Статус: {status}", callback_data=callback_data("show_status")),
+            InlineKeyboardButton("🔄 Вкл/Выкл", callback_data=callback_data("toggle")),
         )
         keyboard.row(
-            InlineKeyboardButton("⚙️ API", callback_data="set_api"),
-            InlineKeyboardButton(f"📌 Лоты ({lots_count})", callback_data="manage_lots"),
+            InlineKeyboardButton("⚙️ API", callback_data=callback_data("set_api")),
+            InlineKeyboardButton(
+                f"📌 Лоты ({lots_count})", callback_data=callback_data("manage_lots")
+            ),
         )
 
         text = f"""
@@ -373,102 +3339,222 @@ class StarsGifterPlugin:
 ⚙️ <b>API ID:</b> {"✅" if self.config.get("pyrogram", {}).get("api_id") else "❌"}
 📌 <b>Лотов:</b> {lots_count}
 """
+        return text, keyboard
 
+    def show_simple_panel(self, cardinal: "Cardinal", chat_id: int) -> None:
+        text, keyboard = self.render_panel()
         cardinal.telegram.bot.send_message(chat_id, text, reply_markup=keyboard, parse_mode="HTML")
 
+    def render_status(self) -> str:
+        status = "🟢 ВКЛЮЧЕН" if self.running else "🔴 ВЫКЛЮЧЕН"
+        api_id_ok = "✅" if self.config.get("pyrogram", {}).get("api_id") else "❌"
+        api_hash_ok = "✅" if self.config.get("pyrogram", {}).get("api_hash") else "❌"
+        lots = len(self.lot_stars_mapping)
+        queue = self.scheduler.stats()
+        if self.get_setting("catalog", "enabled") and self.catalog.gifts:
+            catalog = f"каталог, {self.catalog.age / 60:.0f} мин назад"
+        else:
+            catalog = "из конфига"
+
+        info = (
+            "<b>📊 Информация</b>\n\n"
+            f"• Статус: {status}\n"
+            f"• API ID: {api_id_ok}\n"
+            f"• API HASH: {api_hash_ok}\n"
+            f"• Лотов: {lots}\n"
+            f"• Номиналы: {', '.join(str(p) for p in sorted(self.random_gifts)) or '—'}"
+            f" ({catalog})\n"
+            f"• Очередь: {queue['queued']} (в работе {queue['active']}/{queue['workers']})\n"
+            f"• Ожидание: ср. {queue['avg_wait']:.1f} с, макс. {queue['max_wait']:.1f} с\n"
+            f"\n<b>👤 Аккаунты</b>\n"
+        )
+        for account in self.senders.accounts:
+            if account.is_ready:
+                state = "🟢"
+            elif account.is_connected:
+                state = "🟡"
+            elif account.connecting:
+                state = "⏳"
+            else:
+                state = "🔴"
+            balance = account.balance.balance
+            info += (
+                f"{state} <code>{account.name}</code>\n"
+                f"   {account.rate_limiter.rate:.2f} подарка/с, "
+                f"FloodWait: {account.rate_limiter.flood_waits}, "
+                f"отправлено: {account.gifts_sent}\n"
+                f"   Баланс: {'?' if balance is None else balance}⭐ "
+                f"(резерв {account.balance.reserved}⭐), "
+                f"кэш: {len(account.recipients)} "
+                f"({account.recipients.hits}/{account.recipients.misses})\n"
+            )
+
+        sent = self.metrics.counter("starsgifter_gifts_sent_total")
+        failed = self.metrics.counter("starsgifter_gifts_failed_total")
+        floods = self.metrics.counter("starsgifter_flood_waits_total")
+        info += (
+            f"\n<b>⏱ Этапы (p50 / p95)</b>\n"
+            f"Подарков: {sent:.0f} ✅ / {failed:.0f} ❌, FloodWait: {floods:.0f}\n"
+        )
+        for stage, count, p50, p95 in self.metrics.stage_summary():
+            title = STAGE_TITLES.get(stage, stage)
+            info += f"• {title}: {p50:.1f} / {p95:.1f} с ({count})\n"
+        return info
+
+    def edit_panel(
+        self,
+        cardinal: "Cardinal",
+        call,
+        text: str,
+        keyboard: Optional[InlineKeyboardMarkup] = None,
+    ) -> None:
+        """Заменить сообщение панели на месте; если нельзя — отправить новое"""
+        bot = cardinal.telegram.bot
+        try:
+            bot.edit_message_text(
+                text,
+                call.message.chat.id,
+                call.message.message_id,
+                reply_markup=keyboard,
+                parse_mode="HTML",
+            )
+        except Exception as e:
+            if "message is not modified" in str(e):
+                return
+            bot.send_message(call.message.chat.id, text, reply_markup=keyboard, parse_mode="HTML")
+
+    def dispatch_callback(self, cardinal: "Cardinal", call) -> None:
+        """Единый обработчик кнопок панели: sg:<действие>[:<аргумент>]"""
+        action, _, arg = call.data[len(CALLBACK_PREFIX) :].partition(":")
+        route = self.panel_routes.get(action)
+        notice = None
+        try:
+            if route is not None:
+                notice = route(call, arg)
+        except Exception as e:
+            logger.error("%s ❌ Ошибка кнопки %s: %s", LOGGER_PREFIX, action, e)
+            notice = "❌ Ошибка"
+        try:
+            cardinal.telegram.bot.answer_callback_query(
+                call.id, notice, show_alert=notice is not None
+            )
+        except Exception:
+            pass
+
     def setup_simple_callbacks(self, cardinal: "Cardinal") -> None:
-        @cardinal.telegram.bot.callback_query_handler(func=lambda c: c.data == "show_status")
-        def show_status_btn(call):
-            status = "🟢 ВКЛЮЧЕН" if self.running else "🔴 ВЫКЛЮЧЕН"
-            api_id_ok = "✅" if self.config.get("pyrogram", {}).get("api_id") else "❌"
-            api_hash_ok = "✅" if self.config.get("pyrogram", {}).get("api_hash") else "❌"
-            lots = len(self.lot_stars_mapping)
-
-            info = (
-                "<b>📊 Информация</b>\n\n"
-                f"• Статус: {status}\n"
-                f"• API ID: {api_id_ok}\n"
-                f"• API HASH: {api_hash_ok}\n"
-                f"• Лотов: {lots}"
-            )
-            cardinal.telegram.bot.send_message(call.message.chat.id, info, parse_mode="HTML")
-
-        @cardinal.telegram.bot.callback_query_handler(func=lambda c: c.data == "toggle")
-        def toggle_btn(call):
+        bot = cardinal.telegram.bot
+        back_to_main = InlineKeyboardButton("🔙 Назад", callback_data=callback_data("back_to_main"))
+
+        def show_status_btn(call, arg):
+            keyboard = InlineKeyboardMarkup(row_width=1)
+            keyboard.add(
+                InlineKeyboardButton("🔄 Обновить", callback_data=callback_data("show_status"))
+            )
+            keyboard.add(back_to_main)
+            self.edit_panel(cardinal, call, self.render_status(), keyboard)
+
+        def toggle_btn(call, arg):
             self.running = not self.running
             self.config["plugin_enabled"] = self.running
             self.persist_config()
 
+            self.edit_panel(cardinal, call, *self.render_panel())
             status = "✅" if self.running else "❌"
-            cardinal.telegram.bot.answer_callback_query(call.id, f"Плагин {status}", show_alert=True)
-            cardinal.telegram.bot.delete_message(call.message.chat.id, call.message.message_id)
-            self.show_simple_panel(cardinal, call.message.chat.id)
+            return f"Плагин {status}"
 
-        @cardinal.telegram.bot.callback_query_handler(func=lambda c: c.data == "set_api")
-        def set_api_btn(call):
+        def set_api_btn(call, arg):
             keyboard = InlineKeyboardMarkup(row_width=1)
-            keyboard.add(InlineKeyboardButton("📝 API ID", callback_data="input_api_id"))
-            keyboard.add(InlineKeyboardButton("📝 API HASH", callback_data="input_api_hash"))
-            keyboard.add(InlineKeyboardButton("🔙 Назад", callback_data="back_to_main"))
-            cardinal.telegram.bot.send_message(
-                call.message.chat.id,
-                "⚙️ <b>API</b>",
-                reply_markup=keyboard,
-                parse_mode="HTML",
+            keyboard.add(InlineKeyboardButton("📝 API ID", callback_data=callback_data("api_id")))
+            keyboard.add(
+                InlineKeyboardButton("📝 API HASH", callback_data=callback_data("api_hash"))
             )
+            keyboard.add(back_to_main)
+            self.edit_panel(cardinal, call, "⚙️ <b>API</b>", keyboard)
 
-        @cardinal.telegram.bot.callback_query_handler(func=lambda c: c.data == "input_api_id")
-        def input_api_id_btn(call):
-            msg = cardinal.telegram.bot.send_message(call.message.chat.id, "📝 API ID:")
-            cardinal.telegram.bot.register_next_step_handler(msg, self.process_api_id, cardinal)
+        def input_api_id_btn(call, arg):
+            msg = bot.send_message(call.message.chat.id, "📝 API ID:")
+            bot.register_next_step_handler(msg, self.process_api_id, cardinal)
 
-        @cardinal.telegram.bot.callback_query_handler(func=lambda c: c.data == "input_api_hash")
-        def input_api_hash_btn(call):
-            msg = cardinal.telegram.bot.send_message(call.message.chat.id, "📝 API HASH:")
-            cardinal.telegram.bot.register_next_step_handler(msg, self.process_api_hash, cardinal)
+        def input_api_hash_btn(call, arg):
+            msg = bot.send_message(call.message.chat.id, "📝 API HASH:")
+            bot.register_next_step_handler(msg, self.process_api_hash, cardinal)
 
-        @cardinal.telegram.bot.callback_query_handler(func=lambda c: c.data == "manage_lots")
-        def manage_lots_btn(call):
+        def manage_lots_btn(call, arg):
             keyboard = InlineKeyboardMarkup(row_width=1)
-            keyboard.add(InlineKeyboardButton("➕ Добавить", callback_data="add_lot"))
-            keyboard.add(InlineKeyboardButton("➖ Удалить", callback_data="remove_lot"))
-            keyboard.add(InlineKeyboardButton("📋 Показать", callback_data="show_lots"))
-            keyboard.add(InlineKeyboardButton("🔙 Назад", callback_data="back_to_main"))
-            cardinal.telegram.bot.send_message(
+            keyboard.add(InlineKeyboardButton("➕ Добавить", callback_data=callback_data("add_lot")))
+            keyboard.add(
+                InlineKeyboardButton("➖ Удалить", callback_data=callback_data("remove_lot"))
+            )
+            keyboard.add(
+                InlineKeyboardButton("📋 Показать", callback_data=callback_data("lots_page", 0))
+            )
+            keyboard.row(
+                InlineKeyboardButton("📥 Импорт", callback_data=callback_data("import_lots")),
+                InlineKeyboardButton("📤 Экспорт", callback_data=callback_data("export_lots")),
+            )
+            keyboard.add(back_to_main)
+            self.edit_panel(
+                cardinal, call, f"📌 <b>Лоты ({len(self.lot_stars_mapping)})</b>", keyboard
+            )
+
+        def add_lot_btn(call, arg):
+            msg = bot.send_message(
                 call.message.chat.id,
-                f"📌 <b>Лоты ({len(self.lot_stars_mapping)})</b>",
-                reply_markup=keyboard,
+                "Формат: <code>123456 100</code>",
                 parse_mode="HTML",
             )
+            bot.register_next_step_handler(msg, self.process_add_lot, cardinal)
+
+        def remove_lot_btn(call, arg):
+            msg = bot.send_message(call.message.chat.id, "ID лота:")
+            bot.register_next_step_handler(msg, self.process_remove_lot, cardinal)
+
+        def lots_page_btn(call, arg):
+            page, _, query = arg.partition(":")
+            self.edit_panel(cardinal, call, *self.render_lots_page(int(page or 0), query))
+
+        def search_lots_btn(call, arg):
+            msg = bot.send_message(call.message.chat.id, "🔍 Часть lot_id или количество звёзд:")
+            bot.register_next_step_handler(msg, self.process_search_lots, cardinal)
 
-        @cardinal.telegram.bot.callback_query_handler(func=lambda c: c.data == "add_lot")
-        def add_lot_btn(call):
-            msg = cardinal.telegram.bot.send_message(
+        def import_lots_btn(call, arg):
+            msg = bot.send_message(
                 call.message.chat.id,
-                "Формат: <code>123456 100</code>",
+                "📥 Отправьте файл CSV (<code>lot_id,stars</code>) или JSON "
+                "(<code>{\"lot_id\": stars}</code>). 0 звёзд — удалить лот",
                 parse_mode="HTML",
             )
-            cardinal.telegram.bot.register_next_step_handler(msg, self.process_add_lot, cardinal)
+            bot.register_next_step_handler(msg, self.process_import_lots, cardinal)
 
-        @cardinal.telegram.bot.callback_query_handler(func=lambda c: c.data == "remove_lot")
-        def remove_lot_btn(call):
-            msg = cardinal.telegram.bot.send_message(call.message.chat.id, "ID лота:")
-            cardinal.telegram.bot.register_next_step_handler(msg, self.process_remove_lot, cardinal)
+        def export_lots_btn(call, arg):
+            document = io.BytesIO(self.export_lots())
+            document.name = "starsgifter_lots.csv"
+            bot.send_document(
+                call.message.chat.id, document, caption=f"📤 Лотов: {len(self.lot_stars_mapping)}"
+            )
 
-        @cardinal.telegram.bot.callback_query_handler(func=lambda c: c.data == "show_lots")
-        def show_lots_btn(call):
-            if not self.lot_stars_mapping:
-                text = "❌ Пусто"
-            else:
-                text = "<b>📌 Лоты:</b>\n\n"
-                for lot_id, stars in self.lot_stars_mapping.items():
-                    text += f"• <code>{lot_id}</code> → <b>{stars}⭐</b>\n"
-            cardinal.telegram.bot.send_message(call.message.chat.id, text, parse_mode="HTML")
+        def back_to_main_btn(call, arg):
+            self.edit_panel(cardinal, call, *self.render_panel())
+
+        self.panel_routes = {
+            "show_status": show_status_btn,
+            "toggle": toggle_btn,
+            "set_api": set_api_btn,
+            "api_id": input_api_id_btn,
+            "api_hash": input_api_hash_btn,
+            "manage_lots": manage_lots_btn,
+            "add_lot": add_lot_btn,
+            "remove_lot": remove_lot_btn,
+            "lots_page": lots_page_btn,
+            "search_lots": search_lots_btn,
+            "import_lots": import_lots_btn,
+            "export_lots": export_lots_btn,
+            "back_to_main": back_to_main_btn,
+        }
 
-        @cardinal.telegram.bot.callback_query_handler(func=lambda c: c.data == "back_to_main")
-        def back_to_main_btn(call):
-            cardinal.telegram.bot.delete_message(call.message.chat.id, call.message.message_id)
-            self.show_simple_panel(cardinal, call.message.chat.id)
+        @bot.callback_query_handler(func=lambda c: (c.data or "").startswith(CALLBACK_PREFIX))
+        def panel_callback(call):
+            self.dispatch_callback(cardinal, call)
 
     def process_api_id(self, message, cardinal: "Cardinal") -> None:
         try:
@@ -496,22 +3582,116 @@ class StarsGifterPlugin:
             parts = message.text.strip().split()
             lot_id = parts[0]
             stars = int(parts[1])
+            if not 0 < stars <= MAX_LOT_STARS:
+                cardinal.telegram.bot.send_message(
+                    message.chat.id, f"❌ Звёзд должно быть от 1 до {MAX_LOT_STARS}"
+                )
+                return
+            if self.calc_gifts_quantity(stars) is None:
+                cardinal.telegram.bot.send_message(
+                    message.chat.id, f"❌ {stars}⭐ нельзя собрать из подарков"
+                )
+                return
             self.lot_stars_mapping[lot_id] = stars
-            self.config["lot_stars_mapping"][lot_id] = stars
             self.persist_config()
             cardinal.telegram.bot.send_message(
                 message.chat.id,
                 f"✅ Лот <code>{lot_id}</code> → <b>{stars}⭐</b>",
                 parse_mode="HTML",
             )
-        except (IndexError, ValueError):
+        except (IndexError, ValueError, OverflowError):
             cardinal.telegram.bot.send_message(message.chat.id, "❌ Ошибка")
 
+    def render_lots_page(self, page: int, query: str = "") -> Tuple[str, InlineKeyboardMarkup]:
+        query = query.strip()[:20]
+        items, total, page = self.lot_stars_mapping.page(page, LOTS_PAGE_SIZE, query)
+        pages = max(1, -(-total // LOTS_PAGE_SIZE))
+
+        title = f"🔍 «{html.escape(query)}» " if query else ""
+        text = f"<b>📌 Лоты</b> {title}— {total} (стр. {page + 1}/{pages})\n\n"
+        if not items:
+            text += "❌ Пусто"
+        for lot_id, stars in items:
+            text += f"• <code>{html.escape(lot_id)}</code> → <b>{stars}⭐</b>\n"
+
+        keyboard = InlineKeyboardMarkup(row_width=3)
+        nav = []
+        if page > 0:
+            data = callback_data("lots_page", page - 1, query)
+            nav.append(InlineKeyboardButton("⬅️", callback_data=data))
+        if page + 1 < pages:
+            data = callback_data("lots_page", page + 1, query)
+            nav.append(InlineKeyboardButton("➡️", callback_data=data))
+        if nav:
+            keyboard.row(*nav)
+        keyboard.row(
+            InlineKeyboardButton("🔍 Поиск", callback_data=callback_data("search_lots")),
+            InlineKeyboardButton("🔙 Назад", callback_data=callback_data("manage_lots")),
+        )
+        return text, keyboard
+
+    def import_lots(self, text: str) -> Tuple[int, int, int, List[str]]:
+        """Массовое изменение лотов с одной записью конфига: добавлено, изменено, удалено, ошибки"""
+        changes, errors = parse_lot_table(text)
+        updates: Dict[str, int] = {}
+        removed: List[str] = []
+        for lot_id, stars in changes.items():
+            if stars == 0:
+                if lot_id in self.lot_stars_mapping:
+                    removed.append(lot_id)
+            elif self.calc_gifts_quantity(stars) is None:
+                errors.append(f"{lot_id}: {stars}⭐ нельзя собрать из подарков")
+            else:
+                updates[lot_id] = stars
+        added = sum(1 for lot_id in updates if lot_id not in self.lot_stars_mapping)
+        if updates or removed:
+            self.lot_stars_mapping.update(updates, removed)
+            self.persist_config()
+        return added, len(updates) - added, len(removed), errors
+
+    def export_lots(self) -> bytes:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        writer.writerow(["lot_id", "stars"])
+        writer.writerows(self.lot_stars_mapping.items())
+        return buffer.getvalue().encode("utf-8")
+
+    def process_search_lots(self, message, cardinal: "Cardinal") -> None:
+        text, keyboard = self.render_lots_page(0, message.text or "")
+        cardinal.telegram.bot.send_message(
+            message.chat.id, text, reply_markup=keyboard, parse_mode="HTML"
+        )
+
+    def process_import_lots(self, message, cardinal: "Cardinal") -> None:
+        bot = cardinal.telegram.bot
+        document = getattr(message, "document", None)
+        try:
+            if document is not None:
+                file_info = bot.get_file(document.file_id)
+                text = bot.download_file(file_info.file_path).decode("utf-8-sig")
+            else:
+                text = message.text or ""
+        except Exception as e:
+            bot.send_message(message.chat.id, f"❌ Ошибка: {e}")
+            return
+
+        added, updated, removed, errors = self.import_lots(text)
+        result = (
+            f"📥 <b>Импорт лотов</b>\n\n"
+            f"• Добавлено: {added}\n"
+            f"• Изменено: {updated}\n"
+            f"• Удалено: {removed}\n"
+            f"• Всего лотов: {len(self.lot_stars_mapping)}\n"
+        )
+        if errors:
+            result += f"\n❌ Ошибок: {len(errors)}\n"
+            result += "".join(f"• {html.escape(error)}\n" for error in errors[:10])
+        bot.send_message(message.chat.id, result, parse_mode="HTML")
+
     def process_remove_lot(self, message, cardinal: "Cardinal") -> None:
         lot_id = message.text.strip()
         if lot_id in self.lot_stars_mapping:
             self.lot_stars_mapping.pop(lot_id)
-            self.config["lot_stars_mapping"].pop(lot_id, None)
             self.persist_config()
             cardinal.telegram.bot.send_message(
                 message.chat.id,
@@ -521,16 +3701,177 @@ class StarsGifterPlugin:
         else:
             cardinal.telegram.bot.send_message(message.chat.id, "❌ Не найден", parse_mode="HTML")
 
+    def setup_logging(self) -> None:
+        if not self.get_setting("logging", "async") or self.log_listener is not None:
+            return
+        self.log_listener = setup_async_logging(
+            logger,
+            repeat_interval=self.get_setting("logging", "repeat_interval"),
+            repeat_burst=self.get_setting("logging", "repeat_burst"),
+        )
+
     def init_plugin(self, cardinal: "Cardinal") -> None:
-        logger.info(f"{LOGGER_PREFIX} 🚀 {NAME} v{VERSION}")
+        self.load_config()
+        self.setup_logging()
+        logger.info("%s 🚀 %s v%s", LOGGER_PREFIX, NAME, VERSION)
+        self.cardinal = cardinal
+        self.restore_states()
+        self.stopping = False
+        self.drain_deadline = None
+        self.drain_event = asyncio.Event()
+        self._stopped = False
+        self._shutdown_done.clear()
+        self._sigterm_thread = None
+        interrupted = self.store.list_orders([ORDER_QUEUED, ORDER_DELIVERING])
+        if interrupted:
+            logger.warning(
+                "%s ⚠️ Прерванных заказов: %s — см. /stars_resume",
+                LOGGER_PREFIX, len(interrupted),
+            )
+        self.config_file.start(
+            self.apply_config,
+            save_delay=self.get_setting("config", "save_delay"),
+            reload_interval=self.get_setting("config", "reload_interval"),
+        )
+        self.outbound.start()
+        self.start_sweeper()
+        self.register_gauges()
+        self.exporter.start()
+        self.loop_thread.start()
+        self.scheduler.start(self.loop_thread.loop)
         self.init_pyrogram()
+        self.resume_paused_orders()
+        atexit.register(self.shutdown)
+        self.install_signal_handler()
 
         @cardinal.telegram.bot.message_handler(commands=["stars_panel"])
         def panel(m):
             self.show_simple_panel(cardinal, m.chat.id)
 
+        @cardinal.telegram.bot.message_handler(commands=["stars_resume"])
+        def resume(m):
+            parts = m.text.split()
+            if len(parts) < 2:
+                text = self.list_resumable_orders()
+            else:
+                text = self.resume_order(cardinal, parts[1].lstrip("#"))
+            cardinal.telegram.bot.send_message(m.chat.id, text, parse_mode="HTML")
+
         self.setup_simple_callbacks(cardinal)
-        logger.info(f"{LOGGER_PREFIX} ✅ Загружен")
+        logger.info("%s ✅ Загружен", LOGGER_PREFIX)
+
+    def drain(self, timeout: float, checkpoint_timeout: float) -> int:
+        """Дождаться доставок; после timeout заказы откладываются между подарками.
+
+        Возвращает число заказов, которые не успели дойти до контрольной точки.
+        """
+        with self._orders_lock:
+            futures = list(self.order_futures.values())
+        if not futures:
+            return 0
+        logger.info("%s ⏳ Остановка: жду %s заказов", LOGGER_PREFIX, len(futures))
+        _, pending = concurrent.futures.wait(futures, timeout)
+        if not pending:
+            return 0
+        # Подарок в полёте дожидается ответа Telegram, следующий уже не начинается
+        self.drain_deadline = time.monotonic()
+        if self.drain_event is not None and self.loop_thread.is_running:
+            self.loop_thread.loop.call_soon_threadsafe(self.drain_event.set)
+        _, pending = concurrent.futures.wait(pending, checkpoint_timeout)
+        return len(pending)
+
+    def install_signal_handler(self) -> None:
+        """SIGTERM (остановка сервиса или контейнера) запускает мягкую остановку"""
+        if threading.current_thread() is not threading.main_thread():
+            return
+        if self._sigterm_installed:
+            return
+        self._previous_sigterm = signal.getsignal(signal.SIGTERM)
+        signal.signal(signal.SIGTERM, self._on_sigterm)
+        self._sigterm_installed = True
+
+    def _on_sigterm(self, signum: int, frame) -> None:
+        # Обработчик сигнала прерывает главный поток, где могут быть заняты
+        # блокировки плагина, — остановка идёт в отдельном потоке, а сигнал
+        # повторяется, когда она закончится
+        if not self._shutdown_done.is_set():
+            if self._sigterm_thread is None:
+                logger.warning("%s 🛑 Получен SIGTERM", LOGGER_PREFIX)
+                self._sigterm_thread = threading.Thread(
+                    target=self._shutdown_and_resignal,
+                    args=(signum,),
+                    name="StarsGifterShutdown",
+                )
+                self._sigterm_thread.start()
+            return
+        previous = self._previous_sigterm
+        if callable(previous):
+            previous(signum, frame)
+        elif previous != signal.SIG_IGN:
+            # Обработчика не было — завершаем процесс как по умолчанию
+            signal.signal(signum, signal.SIG_DFL)
+            os.kill(os.getpid(), signum)
+
+    def _shutdown_and_resignal(self, signum: int) -> None:
+        try:
+            self.shutdown()
+            self._shutdown_done.wait()
+        finally:
+            self._shutdown_done.set()
+            os.kill(os.getpid(), signum)
+
+    async def _stop_senders(self) -> None:
+        for task in (self._balance_task, self._catalog_task):
+            if task is not None:
+                task.cancel()
+        self._balance_task = self._catalog_task = None
+        for account in self.senders.accounts:
+            if not account.is_connected:
+                continue
+            try:
+                await account.client.stop()
+            except Exception as e:
+                logger.warning("%s ⚠️ Ошибка остановки %s: %s", LOGGER_PREFIX, account.name, e)
+
+    def shutdown(self, *args) -> None:
+        """Мягкая остановка: BIND_TO_DELETE и выход процесса (atexit)"""
+        with self._shutdown_lock:
+            if self._stopped:
+                return
+            self._stopped = True
+        self.stopping = True
+        stuck = self.drain(
+            self.get_setting("shutdown", "drain_timeout"),
+            self.get_setting("shutdown", "checkpoint_timeout"),
+        )
+        if stuck:
+            logger.error(
+                "%s ❌ Заказов без контрольной точки: %s — см. /stars_resume",
+                LOGGER_PREFIX, stuck,
+            )
+
+        self._sweeper_stop.set()
+        if self._sweeper is not None:
+            self._sweeper.join(5)
+        if self.connect_future is not None:
+            self.connect_future.cancel()
+        if self.loop_thread.is_running:
+            try:
+                self.loop_thread.run(self._stop_senders(), timeout=10)
+            except Exception as e:
+                logger.warning("%s ⚠️ Ошибка остановки Pyrogram: %s", LOGGER_PREFIX, e)
+            self.loop_thread.stop()
+
+        self.outbound.stop()
+        self.exporter.stop()
+        self.config_file.stop()
+        self.store.close()
+        logger.info("%s 🛑 Остановлен", LOGGER_PREFIX)
+        if self.log_listener is not None:
+            stop_async_logging(logger, self.log_listener)
+            self.log_listener = None
+        atexit.unregister(self.shutdown)
+        self._shutdown_done.set()
 
 
 PLUGIN = StarsGifterPlugin()
@@ -548,7 +3889,11 @@ def handle_new_message(cardinal: "Cardinal", event: NewMessageEvent, *args) -> N
     PLUGIN.handle_new_message(cardinal, event, *args)
 
 
+def shutdown(*args) -> None:
+    PLUGIN.shutdown()
+
+
 BIND_TO_PRE_INIT = [init_plugin]
 BIND_TO_NEW_ORDER = [handle_new_order]
 BIND_TO_NEW_MESSAGE = [handle_new_message]
-BIND_TO_DELETE = []
+BIND_TO_DELETE = [shutdown]
@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+"""Нагрузочный тест StarsGifter без Telegram и FunPay.
+
+Плагин прогоняется целиком: handle_new_order → handle_new_message (username)
+→ handle_new_message («+») → очередь доставки → send_gift. Вместо Pyrogram
+и Cardinal используются заглушки с настраиваемой задержкой, ошибками и
+FloodWait.
+
+Пример:
+    python benchmarks/bench_starsgifter.py --orders 200 --workers 1 3 8 --latency 0.05
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import types
+from typing import Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PLUGIN_MODULE = "autoGiftStars"
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# ЗАГЛУШКИ ЗАВИСИМОСТЕЙ
+# ═══════════════════════════════════════════════════════════════════════════
+
+
+def install_stand_ins() -> None:
+    """Подставить FunPayAPI и telebot, если они не установлены"""
+    try:
+        importlib.import_module("FunPayAPI.updater.events")
+    except ImportError:
+        events = types.ModuleType("FunPayAPI.updater.events")
+        events.NewOrderEvent = type("NewOrderEvent", (), {})
+        events.NewMessageEvent = type("NewMessageEvent", (), {})
+        sys.modules["FunPayAPI"] = types.ModuleType("FunPayAPI")
+        sys.modules["FunPayAPI.updater"] = types.ModuleType("FunPayAPI.updater")
+        sys.modules["FunPayAPI.updater.events"] = events
+
+    try:
+        importlib.import_module("telebot.types")
+    except ImportError:
+        telebot_types = types.ModuleType("telebot.types")
+
+        class InlineKeyboardMarkup:
+            def __init__(self, *args, **kwargs) -> None:
+                self.keyboard = []
+
+            def row(self, *buttons) -> "InlineKeyboardMarkup":
+                self.keyboard.append(list(buttons))
+                return self
+
+            def add(self, *buttons, **kwargs) -> "InlineKeyboardMarkup":
+                self.keyboard.append(list(buttons))
+                return self
+
+        class InlineKeyboardButton:
+            def __init__(self, text: str, callback_data: Optional[str] = None, **kwargs) -> None:
+                self.text = text
+                self.callback_data = callback_data
+
+        telebot_types.InlineKeyboardMarkup = InlineKeyboardMarkup
+        telebot_types.InlineKeyboardButton = InlineKeyboardButton
+        sys.modules["telebot"] = types.ModuleType("telebot")
+        sys.modules["telebot.types"] = telebot_types
+
+
+class FloodWait(Exception):
+    """Повторяет интерфейс pyrogram.errors.FloodWait (поле value)"""
+
+    def __init__(self, value: int) -> None:
+        super().__init__(f"FLOOD_WAIT_X: wait {value} seconds")
+        self.value = value
+
+
+class FakeClient:
+    """Заглушка pyrogram.Client"""
+
+    def __init__(
+        self,
+        latency: float = 0.05,
+        error_rate: float = 0.0,
+        flood_rate: float = 0.0,
+        flood_seconds: int = 1,
+        balance: Optional[int] = None,
+    ) -> None:
+        self.latency = latency
+        self.error_rate = error_rate
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.balance = balance
+        self.is_connected = True
+        self.gifts_sent = 0
+        self.errors = 0
+        self.flood_waits = 0
+        self.resolves = 0
+        self._random = random.Random(42)
+
+    async def _delay(self) -> None:
+        if self.latency:
+            await asyncio.sleep(self._random.uniform(0.5, 1.5) * self.latency)
+
+    async def start(self) -> "FakeClient":
+        return self
+
+    async def stop(self) -> None:
+        self.is_connected = False
+
+    async def get_users(self, user_ids):
+        await self._delay()
+        self.resolves += 1
+        ids = user_ids if isinstance(user_ids, list) else [user_ids]
+        users = [
+            types.SimpleNamespace(id=abs(hash(str(u))) % 10**9, username=str(u).lstrip("@"))
+            for u in ids
+        ]
+        return users if isinstance(user_ids, list) else users[0]
+
+    async def send_gift(self, chat_id, gift_id, **kwargs) -> bool:
+        await self._delay()
+        roll = self._random.random()
+        if roll < self.flood_rate:
+            self.flood_waits += 1
+            raise FloodWait(self.flood_seconds)
+        if roll < self.flood_rate + self.error_rate:
+            self.errors += 1
+            raise RuntimeError("GIFT_SEND_FAILED")
+        self.gifts_sent += 1
+        return True
+
+    async def get_stars_balance(self, *args, **kwargs) -> int:
+        await self._delay()
+        if self.balance is None:
+            raise AttributeError("balance disabled")
+        return self.balance
+
+
+class FakeAccount:
+    """Заглушка cardinal.account"""
+
+    def __init__(self, latency: float = 0.0) -> None:
+        self.latency = latency
+        self.messages: List[tuple] = []
+        self._lock = threading.Lock()
+
+    def send_message(self, chat_id, text, *args, **kwargs) -> bool:
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.messages.append((chat_id, text))
+        return True
+
+
+class FakeCardinal:
+    """Заглушка Cardinal: только account и пустой telegram"""
+
+    def __init__(self, account: FakeAccount) -> None:
+        self.account = account
+        self.telegram = None
+
+
+def order_event(order_id: str, chat_id: int, buyer_id: int, lot_id: str, amount: int = 1):
+    order = types.SimpleNamespace(
+        id=order_id, chat_id=chat_id, buyer_id=buyer_id, lot_id=lot_id, amount=amount
+    )
+    return types.SimpleNamespace(order=order)
+
+
+def message_event(chat_id: int, author_id: int, text: str):
+    return types.SimpleNamespace(
+        message=types.SimpleNamespace(chat_id=chat_id, author_id=author_id, text=text)
+    )
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# ПРОГОН
+# ═══════════════════════════════════════════════════════════════════════════
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def run_once(module, args: argparse.Namespace, workers: int) -> Dict:
+    workdir = tempfile.mkdtemp(prefix="starsgifter-bench-")
+    os.chdir(workdir)
+    os.makedirs("plugins", exist_ok=True)
+
+    config = json.loads(json.dumps(module.DEFAULT_CONFIG))
+    config["lot_stars_mapping"] = {"1": args.stars}
+    config["pyrogram"].update({"api_id": 1, "api_hash": "bench"})
+    config["delivery"].update({"workers": workers, "retry_backoff": 0.05})
+    config["rate_limit"].update(
+        {"rate": args.rate, "max_rate": args.rate, "burst": max(1, int(args.rate))}
+    )
+    config["balance"]["enabled"] = args.balance is not None
+    config["pyrogram_accounts"] = [
+        {"session_name": f"bench_{i}", "api_id": 1, "api_hash": "bench"}
+        for i in range(1, args.accounts)
+    ]
+    with open(module.CONFIG_FILE, "w", encoding="utf-8") as f:
+        json.dump(config, f)
+
+    done: Dict[str, float] = {}
+    done_event = threading.Event()
+
+    class BenchPlugin(module.StarsGifterPlugin):
+        def _on_delivery_done(self, order_id, future) -> None:
+            super()._on_delivery_done(order_id, future)
+            done[order_id] = time.perf_counter()
+            if len(done) >= args.orders:
+                done_event.set()
+
+    clients = [
+        FakeClient(
+            latency=args.latency,
+            error_rate=args.error_rate,
+            flood_rate=args.flood_rate,
+            flood_seconds=args.flood_seconds,
+            balance=args.balance,
+        )
+        for _ in range(args.accounts)
+    ]
+    account = FakeAccount(latency=args.funpay_latency)
+    cardinal = FakeCardinal(account)
+
+    plugin = BenchPlugin()
+    plugin.load_config()
+    plugin.cardinal = cardinal
+    plugin.loop_thread.start()
+    plugin.scheduler.start(plugin.loop_thread.loop)
+    for sender, client in zip(plugin.senders.accounts, clients):
+        sender.client = client
+    if args.balance is not None:
+        plugin.loop_thread.run(plugin.refresh_balance())
+
+    started: Dict[str, float] = {}
+    handler_times: List[float] = []
+    interval = 1 / args.arrival_rate if args.arrival_rate else 0.0
+    begin = time.perf_counter()
+    for i in range(args.orders):
+        order_id = f"B{i:06d}"
+        chat_id, buyer_id = 10_000 + i, 20_000 + i
+        username = f"@bench_user_{i % args.recipients}"
+        started[order_id] = time.perf_counter()
+        for call, event in (
+            (plugin.handle_new_order, order_event(order_id, chat_id, buyer_id, "1")),
+            (plugin.handle_new_message, message_event(chat_id, buyer_id, username)),
+            (plugin.handle_new_message, message_event(chat_id, buyer_id, "+")),
+        ):
+            t0 = time.perf_counter()
+            call(cardinal, event)
+            handler_times.append(time.perf_counter() - t0)
+        if interval:
+            time.sleep(interval)
+
+    finished = done_event.wait(args.timeout)
+    elapsed = time.perf_counter() - begin
+    plugin.outbound.flush(10)
+
+    latencies = [done[o] - started[o] for o in done]
+    queue = plugin.scheduler.stats()
+    gifts = sum(c.gifts_sent for c in clients)
+    result = {
+        "workers": workers,
+        "accounts": args.accounts,
+        "orders": len(done),
+        "complete": finished,
+        "elapsed": elapsed,
+        "orders_per_s": len(done) / elapsed if elapsed else 0.0,
+        "gifts_per_s": gifts / elapsed if elapsed else 0.0,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "handler_p99_ms": percentile(handler_times, 99) * 1000,
+        "max_queue_wait": queue["max_wait"],
+        "gifts": gifts,
+        "errors": sum(c.errors for c in clients),
+        "flood_waits": sum(c.flood_waits for c in clients),
+        "resolves": sum(c.resolves for c in clients),
+        "funpay_messages": len(account.messages),
+    }
+
+    plugin.loop_thread.stop()
+    plugin.outbound.stop()
+    plugin.store.close()
+    return result
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Нагрузочный тест StarsGifter")
+    parser.add_argument("--orders", type=int, default=100, help="число заказов")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 3, 8], help="воркеры доставки")
+    parser.add_argument("--accounts", type=int, default=1, help="аккаунтов-отправителей")
+    parser.add_argument("--stars", type=int, default=100, help="звёзд в заказе")
+    parser.add_argument("--recipients", type=int, default=50, help="разных получателей")
+    parser.add_argument("--arrival-rate", type=float, default=0.0, help="заказов/с (0 — всё сразу)")
+    parser.add_argument("--latency", type=float, default=0.05, help="задержка Telegram API, с")
+    parser.add_argument("--funpay-latency", type=float, default=0.0, help="задержка FunPay, с")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ошибок send_gift")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="доля FloodWait")
+    parser.add_argument("--flood-seconds", type=int, default=1, help="длительность FloodWait, с")
+    parser.add_argument("--rate", type=float, default=1000.0, help="лимит подарков/с")
+    parser.add_argument("--balance", type=int, default=None, help="баланс звёзд (по умолчанию не проверяется)")
+    parser.add_argument("--timeout", type=float, default=300.0, help="максимум ожидания прогона, с")
+    parser.add_argument("--log-level", default="CRITICAL", help="уровень логов плагина")
+    parser.add_argument("--json", action="store_true", help="вывести результаты в JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    install_stand_ins()
+    sys.path.insert(0, ROOT)
+    cwd = os.getcwd()
+    module = importlib.import_module(PLUGIN_MODULE)
+    module.logger.setLevel(args.log_level.upper())
+
+    results = []
+    try:
+        for workers in args.workers:
+            results.append(run_once(module, args, workers))
+    finally:
+        os.chdir(cwd)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return 0
+
+    header = (
+        f"{'workers':>7} {'orders':>6} {'time,s':>7} {'ord/s':>7} {'gift/s':>7} "
+        f"{'p50,s':>6} {'p95,s':>6} {'p99,s':>6} {'hdl p99,ms':>10} {'flood':>5} {'err':>4}"
+    )
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(
+            f"{r['workers']:>7} {r['orders']:>6} {r['elapsed']:>7.2f} {r['orders_per_s']:>7.1f} "
+            f"{r['gifts_per_s']:>7.1f} {r['p50']:>6.2f} {r['p95']:>6.2f} {r['p99']:>6.2f} "
+            f"{r['handler_p99_ms']:>10.2f} {r['flood_waits']:>5} {r['errors']:>4}"
+            + ("" if r["complete"] else "  (таймаут)")
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
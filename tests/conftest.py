@@ -0,0 +1,10 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "benchmarks")]
+
+from bench_starsgifter import install_stand_ins  # noqa: E402
+
+# FunPayAPI и telebot нужны плагину только на импорте; без Cardinal — заглушки бенчмарка
+install_stand_ins()
@@ -0,0 +1,54 @@
+import itertools
+
+import pytest
+
+from autoGiftStars import GiftPlanner
+
+DENOMINATIONS = [100, 50, 25, 15]
+
+
+def brute_force_count(amount, denominations):
+    best = None
+    ranges = [range(amount // d + 1) for d in denominations]
+    for counts in itertools.product(*ranges):
+        if sum(c * d for c, d in zip(counts, denominations)) == amount:
+            total = sum(counts)
+            best = total if best is None else min(best, total)
+    return best
+
+
+@pytest.mark.parametrize("denominations", [DENOMINATIONS, [100, 60, 1], [7, 5]])
+def test_plan_is_minimal(denominations):
+    planner = GiftPlanner(denominations, max_amount=250)
+    for amount in range(1, 251):
+        plan = planner.plan(amount)
+        expected = brute_force_count(amount, denominations)
+        if expected is None:
+            assert plan is None, amount
+            continue
+        assert sum(price * count for price, count in plan.items()) == amount
+        assert sum(plan.values()) == expected, amount
+
+
+@pytest.mark.parametrize("max_amount", [0, 50, 99])
+def test_max_amount_below_largest_gift(max_amount):
+    planner = GiftPlanner(DENOMINATIONS, max_amount=max_amount)
+    assert planner.max_amount == 100
+    assert planner.plan(64) is None
+    assert planner.plan(65) == {50: 1, 15: 1}
+    for amount in range(1, 1001):
+        plan = planner.plan(amount)
+        if plan is not None:
+            assert sum(price * count for price, count in plan.items()) == amount
+            assert max(plan) <= amount
+
+
+def test_amount_above_table_matches_full_table():
+    small = GiftPlanner(DENOMINATIONS, max_amount=300)
+    full = GiftPlanner(DENOMINATIONS, max_amount=3000)
+    for amount in range(301, 3001):
+        assert small.count(amount) == full.count(amount), amount
+
+
+def test_no_denominations():
+    assert GiftPlanner([], max_amount=100).plan(100) is None
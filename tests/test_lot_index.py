@@ -0,0 +1,41 @@
+import pytest
+
+from autoGiftStars import MAX_LOT_STARS, LotIndex, parse_lot_table
+
+
+def test_update_keeps_arrays_in_sync_on_bad_stars():
+    lots = LotIndex({"100": 15, "200": 25, "300": 50})
+    with pytest.raises(ValueError):
+        lots.update({"150": 5000000000})
+    assert lots.to_dict() == {"100": 15, "200": 25, "300": 50}
+    assert lots["200"] == 25
+    assert lots["300"] == 50
+
+
+def test_setitem_rejects_out_of_range_stars():
+    lots = LotIndex({"100": 15})
+    for stars in (2**32, MAX_LOT_STARS + 1, -1):
+        with pytest.raises(ValueError):
+            lots["150"] = stars
+    assert lots.to_dict() == {"100": 15}
+
+
+def test_parse_lot_table_rejects_huge_stars():
+    changes, errors = parse_lot_table("lot_id,stars\n150,5000000000\n160,25\n")
+    assert changes == {"160": 25}
+    assert len(errors) == 1 and errors[0].startswith("2: 150")
+
+
+def test_update_matches_dict():
+    lots = LotIndex()
+    reference = {}
+    for i in range(200):
+        lot_id = str((i * 7919) % 1000)
+        lots[lot_id] = i
+        reference[lot_id] = i
+    lots.update({"abc": 5, "10": 0}, removed=[str(n) for n in range(0, 1000, 3)])
+    reference.update({"abc": 5, "10": 0})
+    for n in range(0, 1000, 3):
+        reference.pop(str(n), None)
+    assert lots.to_dict() == reference
+    assert all(lots[lot_id] == stars for lot_id, stars in reference.items())